@@ -1,16 +1,32 @@
 import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 import yt_dlp
 import yt_dlp.utils
 import os
 import asyncio
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import contextlib
 from dotenv import load_dotenv
 import subprocess
-import ffmpeg
+import shutil
+import sqlite3
+import threading
 import re
 import json
-import uuid # Import the uuid library
+import time
+
+# orjson serializes the session blobs several times faster than the stdlib and is
+# used when available; the stdlib json module is the fallback.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Load environment variables ---
 load_dotenv()
@@ -27,6 +43,10 @@ DOWNLOAD_DESTINATION_DIR = os.getenv("DOWNLOAD_DESTINATION_DIR")
 DELETE_DOWNLOADED_FILES_AFTER_UPLOAD = os.getenv("DELETE_DOWNLOADED_FILES_AFTER_UPLOAD", "true").lower()
 SHOULD_DELETE_FILE = not (DELETE_DOWNLOADED_FILES_AFTER_UPLOAD == "false" or DELETE_DOWNLOADED_FILES_AFTER_UPLOAD == "0")
 TELEGRAM_CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID") # New: Get channel ID
+# Optional: base URL of a self-hosted Bot API server (e.g. http://localhost:8081).
+# When set, files are sent as local paths and the server reads them from disk
+# directly, skipping the multi-GB HTTP upload from this process.
+TELEGRAM_BOT_API_BASE_URL = os.getenv("TELEGRAM_BOT_API_BASE_URL")
 
 # --- Define Telegram file upload maximum limits (2GB = 2000 MB = 2,000,000,000 bytes) ---
 TELEGRAM_MAX_FILE_SIZE_BYTES = 1.95 * 1000 * 1000 * 1000
@@ -47,97 +67,445 @@ if not DOWNLOAD_DESTINATION_DIR:
 # Define user data storage directory
 USER_DATA_DIR = os.path.join(DOWNLOAD_DESTINATION_DIR, "user_data")
 os.makedirs(USER_DATA_DIR, exist_ok=True)
-logger.info(f"Ensuring user data directory '{USER_DATA_DIR}' exists.")
+logger.info("Ensuring user data directory '%s' exists.", USER_DATA_DIR)
+
+# Define thumbnail cache directory; generated thumbnails are kept here and reused
+# (e.g. for the channel forward of a just-sent video) instead of re-running ffmpeg.
+THUMBNAIL_CACHE_DIR = os.path.join(DOWNLOAD_DESTINATION_DIR, "thumbnails")
+os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+THUMBNAIL_CACHE_MAX_ENTRIES = 200
 
 # Global dictionary to store user download session information, including queue and current active download
 user_download_sessions = {}
 
+# Per-chat locks serializing session-mutating callback handling; without them a
+# user mashing buttons interleaves read-modify-write cycles on the same session.
+_session_locks = {}
+
+def _get_session_lock(chat_id):
+    """Returns the asyncio.Lock serializing session mutations for a chat."""
+    lock = _session_locks.get(chat_id)
+    if lock is None:
+        lock = _session_locks.setdefault(chat_id, asyncio.Lock())
+    return lock
+
+def _uid():
+    """Returns an opaque unique id for queue items (cheaper than uuid.uuid4)."""
+    return os.urandom(16).hex()
+
+# URL pattern, compiled once at import. A plain character class keeps matching
+# linear-time; the old inline pattern nested alternations inside (?:...)+ and its
+# double-escaped \\( \\) matched literal backslashes rather than parentheses.
+URL_RE = re.compile(r'https?://[\w$\-.+!*(),%/&=:#?@~]+')
+
 # --- Persistence functions ---
+# Sessions are persisted with a write-behind scheme: save_user_session only marks the
+# chat dirty, and a background flusher task coalesces the many per-status mutations
+# of an active download into a single durable write. The store is one SQLite
+# database in WAL mode (row per chat), so concurrent users share fsyncs instead
+# of each paying per-file open/write/replace cycles.
+_dirty_sessions = set()
+_save_event = asyncio.Event()
+SESSION_FLUSH_DELAY_SECONDS = 0.5
+
+SESSIONS_DB_PATH = os.path.join(USER_DATA_DIR, "sessions.db")
+_sessions_db = None
+
+def _get_sessions_db():
+    """Returns the process-wide SQLite connection, opening it on first use."""
+    global _sessions_db
+    if _sessions_db is None:
+        # check_same_thread=False: reads/writes also run via asyncio.to_thread;
+        # the sqlite3 module serializes access internally.
+        conn = sqlite3.connect(SESSIONS_DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, blob BLOB)")
+        _sessions_db = conn
+    return _sessions_db
+
+# chat_id -> legacy data file path, so repeated lookups don't re-join strings.
+_user_data_paths = {}
+
 def get_user_data_filepath(chat_id):
-    """Gets the full path for the user's data file."""
-    return os.path.join(USER_DATA_DIR, f"{chat_id}.json")
+    """Gets the path of the user's pre-SQLite data file (computed once per chat)."""
+    path = _user_data_paths.get(chat_id)
+    if path is None:
+        path = _user_data_paths.setdefault(chat_id, os.path.join(USER_DATA_DIR, f"{chat_id}.json"))
+    return path
+
+def _read_legacy_session_file(chat_id):
+    """Reads a pre-SQLite per-chat JSON file, if one exists (blocking)."""
+    try:
+        with open(get_user_data_filepath(chat_id), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error("Error while reading legacy session file for user %s: %s", chat_id, e)
+        return None
 
-def load_user_session(chat_id):
-    """Loads session data for a specific user from file."""
-    filepath = get_user_data_filepath(chat_id)
-    if os.path.exists(filepath):
+def _read_session_file(chat_id):
+    """Reads session data for a specific user from the store (blocking)."""
+    try:
+        row = _get_sessions_db().execute(
+            "SELECT blob FROM sessions WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.error("Database error while loading session data for user %s: %s", chat_id, e)
+        return None
+    raw = row[0] if row else _read_legacy_session_file(chat_id)
+    if raw is not None:
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                session_data = json.load(f)
-                # Ensure essential keys exist, initialize if not
-                session_data.setdefault('active_download', None)
-                session_data.setdefault('queue', [])
-                session_data.setdefault('last_user_message_id', None)
-                session_data.setdefault('selection_buttons_message_id', None)
-                return session_data
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decoding error while loading session data for user {chat_id}: {e}")
+            session_data = orjson.loads(raw) if orjson else json.loads(raw)
+            # Ensure essential keys exist, initialize if not
+            session_data.setdefault('active_download', None)
+            session_data.setdefault('queue', {})
+            # Legacy sessions stored the queue as a list; key it by unique_id so
+            # lookups/removals are O(1) instead of rebuilding the whole list.
+            if isinstance(session_data['queue'], list):
+                session_data['queue'] = {
+                    item.setdefault('unique_id', _uid()): item
+                    for item in session_data['queue']
+                }
+            session_data.setdefault('last_user_message_id', None)
+            session_data.setdefault('selection_buttons_message_id', None)
+            # Rebuilt on every load so it can never drift from the queue.
+            session_data['url_index'] = {
+                item['url']: uid for uid, item in session_data['queue'].items()
+            }
+            return session_data
+        except ValueError as e: # covers json.JSONDecodeError and orjson.JSONDecodeError
+            logger.error("JSON decoding error while loading session data for user %s: %s", chat_id, e)
             return None # Return None if loading failed, indicating re-initialization is needed
         except Exception as e:
-            logger.error(f"Error while loading session data for user {chat_id}: {e}")
+            logger.error("Error while loading session data for user %s: %s", chat_id, e)
             return None
     return None
 
-def save_user_session(chat_id, session_data):
-    """Saves session data for a specific user to file."""
-    filepath = get_user_data_filepath(chat_id)
+async def load_user_session(chat_id):
+    """Loads session data for a specific user from the store without blocking the event loop."""
+    return await asyncio.to_thread(_read_session_file, chat_id)
+
+# Digest of the last payload written per chat, so no-op saves (a flush after a
+# mutation that ended up back at the persisted state) skip the disk write.
+_last_saved_digests = {}
+
+def _write_session_file(chat_id, session_data):
+    """Writes session data for a specific user to the store (blocking)."""
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(session_data, f, ensure_ascii=False, indent=4)
+        if orjson:
+            payload = orjson.dumps(session_data)
+        else:
+            payload = json.dumps(session_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.md5(payload).digest()
+        if _last_saved_digests.get(chat_id) == digest:
+            return
+        _get_sessions_db().execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, blob) VALUES (?, ?)", (chat_id, payload)
+        )
+        _last_saved_digests[chat_id] = digest
     except Exception as e:
-        logger.error(f"Error while saving session data for user {chat_id}: {e}")
+        logger.error("Error while saving session data for user %s: %s", chat_id, e)
+
+def save_user_session(chat_id, session_data):
+    """Marks session data for a specific user dirty; the background flusher persists it."""
+    user_download_sessions[chat_id] = session_data
+    _dirty_sessions.add(chat_id)
+    _save_event.set()
+
+async def save_user_session_now(chat_id, session_data):
+    """Write-through for terminal transitions (completed/failed/cancelled) that
+    must survive a crash inside the debounce window; the blocking store write
+    runs off the event loop.
+    """
+    user_download_sessions[chat_id] = session_data
+    _dirty_sessions.discard(chat_id)
+    await asyncio.to_thread(_write_session_file, chat_id, session_data)
+
+def flush_all_sessions():
+    """Synchronously writes out all dirty sessions (used at shutdown)."""
+    while _dirty_sessions:
+        chat_id = _dirty_sessions.pop()
+        session_data = user_download_sessions.get(chat_id)
+        if session_data is not None:
+            _write_session_file(chat_id, session_data)
+
+@contextlib.asynccontextmanager
+async def session_txn(chat_id):
+    """Groups a span of session mutations into one save.
+
+    Yields the cached session (loading it on a miss) and marks it dirty once on
+    exit — including on error — instead of once per mutation inside the block.
+    Callbacks are already serialized by the per-chat lock, so nothing else can
+    observe the intermediate states.
+    """
+    session = user_download_sessions.get(chat_id)
+    if session is None:
+        session = await load_user_session(chat_id)
+        if session:
+            user_download_sessions[chat_id] = session
+    try:
+        yield session
+    finally:
+        if session is not None:
+            save_user_session(chat_id, session)
+
+@contextlib.asynccontextmanager
+async def session_scope(chat_id):
+    """Per-chat lock plus session_txn for a whole handler invocation.
+
+    Serializes concurrent callbacks from the same chat and persists whatever
+    the handler mutated exactly once when it returns.
+    """
+    async with _get_session_lock(chat_id):
+        async with session_txn(chat_id) as session:
+            yield session
+
+# --- Queue helpers ---
+# The queue dict is keyed by unique_id; url_index maps url -> unique_id so
+# duplicate checks cost one lookup instead of a scan. All queue insertions and
+# removals go through these two helpers to keep the index in sync.
+
+def _queue_add(session, item):
+    """Inserts an item into the session queue and indexes its url."""
+    session['queue'][item['unique_id']] = item
+    session.setdefault('url_index', {})[item['url']] = item['unique_id']
+
+def _queue_pop(session, unique_id):
+    """Removes an item from the session queue (and url index) by unique_id."""
+    item = session['queue'].pop(unique_id, None)
+    if item is not None:
+        session.get('url_index', {}).pop(item.get('url'), None)
+    return item
+
+async def _session_flusher():
+    """Background task that debounces dirty-session writes into one I/O per burst."""
+    while True:
+        await _save_event.wait()
+        await asyncio.sleep(SESSION_FLUSH_DELAY_SECONDS)
+        _save_event.clear()
+        while _dirty_sessions:
+            chat_id = _dirty_sessions.pop()
+            session_data = user_download_sessions.get(chat_id)
+            if session_data is not None:
+                await asyncio.to_thread(_write_session_file, chat_id, session_data)
+
+# --- yt-dlp instance cache ---
+# Constructing a YoutubeDL re-initializes the extractor registry and options every
+# time, which costs a few hundred ms of pure Python work per video. The option sets
+# used here are constant per call site, so keep one long-lived instance per frozen
+# opts key. YoutubeDL is not reentrant, so each cached instance gets its own lock.
+_ydl_locks = {}
+
+def _freeze_opts(opts):
+    """Turns an options dict into a hashable cache key."""
+    return tuple(sorted(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in opts.items()
+    ))
+
+# (opts_key, pool_slot) -> generation, bumped by _retire_ydl to permanently
+# sideline an instance whose download thread may still be running.
+_ydl_generations = {}
+
+@functools.lru_cache(maxsize=16)
+def _build_ydl(opts_key, pool_slot, generation):
+    return yt_dlp.YoutubeDL(dict(opts_key))
+
+def _get_ydl(opts_key, pool_slot=0):
+    """Returns a long-lived YoutubeDL instance for the given frozen options.
+
+    pool_slot only differentiates cache entries, so call sites that want to run
+    several extractions concurrently can hold a small pool of instances.
+    """
+    generation = _ydl_generations.get((opts_key, pool_slot), 0)
+    return _build_ydl(opts_key, pool_slot, generation)
+
+def _retire_ydl(opts_key, pool_slot=0):
+    """Ensures the current cached instance for key/slot is never handed out again.
+
+    Used after a download timeout: the abandoned worker thread cannot be
+    cancelled and may still be driving the instance, so the next _get_ydl must
+    return a fresh one rather than racing the zombie.
+    """
+    key = (opts_key, pool_slot)
+    _ydl_generations[key] = _ydl_generations.get(key, 0) + 1
+
+def _get_ydl_lock(opts_key, pool_slot=0):
+    """Returns the asyncio.Lock guarding the cached instance for opts_key."""
+    lock_key = (opts_key, pool_slot)
+    lock = _ydl_locks.get(lock_key)
+    if lock is None:
+        lock = _ydl_locks.setdefault(lock_key, asyncio.Lock())
+    return lock
+
+# Options shared by every YoutubeDL call site. Keeping them identical means the
+# title probes and the download path configure their extractors the same way, so
+# the long-lived cached instances (see _get_ydl) reuse keep-alive connections
+# instead of paying a fresh TCP+TLS handshake per probe.
+YDL_OPTS_COMMON = {
+    'noplaylist': True,
+    'restrictfilenames': True,
+    'nocheckcertificate': True,
+    'quiet': True,
+    'no_warnings': True,
+    'socket_timeout': 30,
+}
 
 # --- Helper to extract video titles ---
+YDL_OPTS_TITLE = {
+    **YDL_OPTS_COMMON,
+    'simulate': True,
+    'forcetitle': True,
+    'skip_download': True, # Ensure no download
+}
+
+# Title probes for a multi-link message run concurrently (asyncio.gather in
+# handle_video_link). A single cached instance would serialize them on its lock,
+# so probes round-robin over a small pool; the per-slot locks also cap extractor
+# concurrency at the pool size.
+TITLE_PROBE_POOL_SIZE = 4
+_title_probe_counter = itertools.count()
+
+# Downloads hash chats onto a small slot pool for the same reason: nearly every
+# chat downloads with the default 'best' format, so a single shared instance
+# would serialize whole multi-minute transfers across chats behind one lock.
+DOWNLOAD_POOL_SIZE = 4
+
 async def get_video_title(url):
     """Asynchronously extracts video title using yt-dlp simulate mode with a timeout."""
-    ydl_opts_title = {
-        'noplaylist': True,
-        'restrictfilenames': True,
-        'nocheckcertificate': True,
-        'quiet': True,
-        'no_warnings': True,
-        'simulate': True,
-        'forcetitle': True,
-        'skip_download': True, # Ensure no download
-    }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts_title) as ydl_title:
+        ydl_title_key = _freeze_opts(YDL_OPTS_TITLE)
+        pool_slot = next(_title_probe_counter) % TITLE_PROBE_POOL_SIZE
+        ydl_title = _get_ydl(ydl_title_key, pool_slot)
+        async with _get_ydl_lock(ydl_title_key, pool_slot):
             info_dict = await asyncio.wait_for(
                 asyncio.to_thread(ydl_title.extract_info, url, download=False),
                 timeout=VIDEO_PARSE_TIMEOUT_SECONDS # Use the defined timeout
             )
-            return info_dict.get('title', '[解析失败]'), None # Return title and no error
+        return info_dict.get('title', '[解析失败]'), None # Return title and no error
     except asyncio.TimeoutError:
-        logger.warning(f"Failed to get title for {url} due to timeout ({VIDEO_PARSE_TIMEOUT_SECONDS}s)")
+        logger.warning("Failed to get title for %s due to timeout (%ss)", url, VIDEO_PARSE_TIMEOUT_SECONDS)
         return "[解析失败]", "timeout"
     except Exception as e:
-        logger.warning(f"Failed to get title for {url}: {e}")
+        logger.warning("Failed to get title for %s: %s", url, e)
         return "[解析失败]", "failed"
 
+# --- ffmpeg hardware acceleration detection (done once at startup) ---
+# Fixed-function decode blocks (VAAPI/NVDEC) cut the software decode out of
+# thumbnail extraction on H.264/HEVC/AV1 input; detection happens once here and
+# extract_thumbnail keeps a software fallback for systems where the accelerated
+# attempt fails.
+def _detect_ffmpeg_hwaccel_args():
+    if os.path.exists('/dev/dri/renderD128'):
+        logger.info("VAAPI render node found, enabling hardware-accelerated thumbnail decode.")
+        return ['-hwaccel', 'vaapi', '-hwaccel_device', '/dev/dri/renderD128', '-hwaccel_output_format', 'vaapi']
+    if shutil.which('nvidia-smi'):
+        logger.info("NVIDIA GPU found, enabling CUDA-accelerated thumbnail decode.")
+        return ['-hwaccel', 'cuda']
+    return []
+
+FFMPEG_HWACCEL_ARGS = _detect_ffmpeg_hwaccel_args()
+
+async def _run_ffmpeg(args):
+    """Runs an ffmpeg command; returns (returncode, stderr bytes)."""
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    return proc.returncode, stderr
+
 # --- Function to extract thumbnail from video's first frame ---
+# Telegram caps thumbnails at 320px, so downscale at extraction; -threads 1
+# skips decoder thread-pool startup, which dominates a one-frame job; -q:v 5
+# is plenty for a 320px preview.
+_THUMBNAIL_OUTPUT_ARGS = ['-vf', 'scale=320:-1', '-frames:v', '1', '-q:v', '5', '-threads', '1']
+
 async def extract_thumbnail(video_path, output_thumbnail_path):
     """
-    Extracts the first frame of a video as a thumbnail using ffmpeg.
-    Now extracts original size thumbnail.
+    Extracts an early frame of a video as a 320px thumbnail by running ffmpeg
+    directly as an async subprocess.
     """
     try:
-        logger.info(f"Extracting thumbnail for {video_path} to {output_thumbnail_path}")
-        await asyncio.to_thread(
-            ffmpeg
-            .input(video_path, ss='00:00:01') # Start from 1 second
-            .output(output_thumbnail_path, vframes=1, q='2') # Set quality, no forced scaling
-            .run, overwrite_output=True, capture_stdout=True, capture_stderr=True
-        )
-        logger.info(f"Thumbnail extraction successful: {output_thumbnail_path}")
+        logger.info("Extracting thumbnail for %s to %s", video_path, output_thumbnail_path)
+        # -ss before -i seeks at the demuxer to the nearest keyframe (O(1)) instead
+        # of decoding every frame up to the timestamp; -noaccurate_seek skips the
+        # decode-forward refinement we don't need for a thumbnail.
+        args = ['ffmpeg', '-y', *FFMPEG_HWACCEL_ARGS,
+                '-noaccurate_seek',
+                '-ss', '00:00:01', # Start from 1 second
+                '-i', video_path]
+        if '-hwaccel_output_format' in FFMPEG_HWACCEL_ARGS:
+            # VAAPI decodes into GPU surfaces; download the frame before scaling
+            args += ['-vf', 'hwdownload,format=nv12,scale=320:-1',
+                     '-frames:v', '1', '-q:v', '5', '-threads', '1']
+        else:
+            args += _THUMBNAIL_OUTPUT_ARGS
+        args += [output_thumbnail_path]
+        returncode, stderr = await _run_ffmpeg(args)
+        if returncode != 0 and FFMPEG_HWACCEL_ARGS:
+            logger.warning("Hardware-accelerated thumbnail decode failed, retrying in software: %s", stderr.decode(errors='replace'))
+            returncode, stderr = await _run_ffmpeg(
+                ['ffmpeg', '-y', '-noaccurate_seek', '-ss', '00:00:01', '-i', video_path,
+                 *_THUMBNAIL_OUTPUT_ARGS, output_thumbnail_path]
+            )
+        if returncode != 0 or not os.path.exists(output_thumbnail_path):
+            # The fast seek can land past the last keyframe of very short files and
+            # produce nothing; retry from the start and take the first frame.
+            logger.warning("Fast keyframe seek produced no thumbnail for %s, retrying from the first frame.", video_path)
+            returncode, stderr = await _run_ffmpeg(
+                ['ffmpeg', '-y', '-ss', '0', '-i', video_path,
+                 *_THUMBNAIL_OUTPUT_ARGS, output_thumbnail_path]
+            )
+        if returncode != 0:
+            logger.error("FFmpeg error occurred during thumbnail extraction: %s", stderr.decode(errors='replace'))
+            return False
+        logger.info("Thumbnail extraction successful: %s", output_thumbnail_path)
         return True
-    except ffmpeg.Error as e:
-        logger.error(f"FFmpeg error occurred during thumbnail extraction: {e.stderr.decode()}", exc_info=True)
-        return False
     except Exception as e:
-        logger.error(f"Unknown error occurred during thumbnail extraction: {e}", exc_info=True)
+        logger.error("Unknown error occurred during thumbnail extraction: %s", e, exc_info=True)
         return False
 
+def _trim_thumbnail_cache():
+    """Deletes the oldest cached thumbnails once the cache exceeds its cap (blocking)."""
+    try:
+        entries = [os.path.join(THUMBNAIL_CACHE_DIR, name) for name in os.listdir(THUMBNAIL_CACHE_DIR)]
+        excess = len(entries) - THUMBNAIL_CACHE_MAX_ENTRIES
+        if excess <= 0:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:excess]:
+            os.remove(path)
+        logger.info("Trimmed %s old thumbnails from cache.", excess)
+    except OSError as e:
+        logger.warning("Failed to trim thumbnail cache: %s", e)
+
+async def get_or_create_thumbnail(video_path, unique_id):
+    """Returns the cached thumbnail path for an item, extracting it on first use.
+
+    Keyed by the item's unique_id, so repeat sends of the same video (user send
+    followed by channel forward, retries at another quality) skip the ffmpeg
+    run. Returns None if extraction fails.
+    """
+    thumbnail_path = os.path.join(THUMBNAIL_CACHE_DIR, f"{unique_id or os.path.basename(video_path)}.jpg")
+    if os.path.exists(thumbnail_path):
+        logger.info("Reusing cached thumbnail: %s", thumbnail_path)
+        return thumbnail_path
+    if not await extract_thumbnail(video_path, thumbnail_path):
+        return None
+    await asyncio.to_thread(_trim_thumbnail_cache)
+    return thumbnail_path
+
 # --- yt-dlp progress hook function ---
+# Per-download capture target for the progress hook. Thread-local rather than a
+# module dict: with chats downloading concurrently on different instances, a
+# shared dict would let one chat's finished-file attributes (or clear()) bleed
+# into another's fallback reads. Hooks run on the download's own worker thread.
+_progress_capture = threading.local()
+
 def yt_dlp_progress_hook(d):
     """
     yt-dlp download progress hook.
@@ -149,44 +517,252 @@ def yt_dlp_progress_hook(d):
         if total_bytes and downloaded_bytes:
             percent = downloaded_bytes / total_bytes * 100
             # logger.debug(f"Download progress: {percent:.2f}%") # Too verbose for regular logging
+    elif d['status'] == 'finished':
+        # Stash the final filename and dimensions yt-dlp already knows, so the
+        # caller never needs another extractor pass to recover them.
+        finished_download = getattr(_progress_capture, 'finished', None)
+        if finished_download is not None:
+            hook_info = d.get('info_dict') or {}
+            finished_download.update(
+                filepath=d.get('filename'),
+                width=hook_info.get('width'),
+                height=hook_info.get('height'),
+            )
+
+def _run_download(ydl, info_dict, finished_download):
+    """Runs process_ie_result with the hook capturing into this download's dict.
+
+    Executes on a worker thread; the thread-local points the module-level hook
+    at finished_download for exactly the span of this call.
+    """
+    _progress_capture.finished = finished_download
+    try:
+        # process_ie_result returns the final info dict (including the real
+        # file path), so no second extractor/network pass is needed.
+        return ydl.process_ie_result(info_dict, True)
+    finally:
+        _progress_capture.finished = None
+
+# --- Status-message edit coalescing ---
+class EditCoalescer:
+    """Merges bursts of edit_message_text calls per (chat_id, message_id).
+
+    Telegram rate-limits edits per chat, and a download edits its status
+    message several times in quick succession. schedule() just records the
+    latest content; one task per message sends it once the minimum interval has
+    passed, so superseded texts are never sent at all. A RetryAfter from the
+    API pauses all pending edits until the server-given deadline.
+    """
+    MIN_INTERVAL_SECONDS = 1.0
+
+    def __init__(self):
+        self._pending = {}   # (chat_id, message_id) -> (bot, kwargs)
+        self._tasks = {}     # (chat_id, message_id) -> asyncio.Task
+        self._last_sent = {} # (chat_id, message_id) -> time.monotonic()
+        self._pause_until = 0.0
+
+    def schedule(self, bot, chat_id, message_id, text, **kwargs):
+        """Records the latest edit for a message and ensures a sender task runs."""
+        key = (chat_id, message_id)
+        self._pending[key] = (bot, dict(kwargs, text=text))
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._flush(key))
+
+    def discard(self, chat_id, message_id):
+        """Drops any pending edit for a message; its sender task exits on its own.
+
+        For callers about to edit the message directly, so a stale queued text
+        cannot be flushed afterwards and overwrite theirs.
+        """
+        self._pending.pop((chat_id, message_id), None)
+
+    async def _flush(self, key):
+        chat_id, message_id = key
+        try:
+            while key in self._pending:
+                now = time.monotonic()
+                wait = max(
+                    self._last_sent.get(key, 0.0) + self.MIN_INTERVAL_SECONDS - now,
+                    self._pause_until - now,
+                )
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                bot, kwargs = self._pending.pop(key)
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+                except RetryAfter as e:
+                    logger.warning("[%s] Edit rate-limited, pausing edits for %ss.", chat_id, e.retry_after)
+                    self._pause_until = time.monotonic() + e.retry_after
+                    # Requeue unless a newer edit arrived while we were sending.
+                    self._pending.setdefault(key, (bot, kwargs))
+                except Exception as e:
+                    logger.warning("[%s] Coalesced edit of message %s failed: %s", chat_id, message_id, e)
+                self._last_sent[key] = time.monotonic()
+        finally:
+            self._tasks.pop(key, None)
+
+edit_coalescer = EditCoalescer()
+
+# Status edits go through the coalescer above; every other direct Bot API call
+# (send_message, send_video, delete_message, copy_message...) is funnelled
+# through _tg so a RetryAfter pauses all callers for the server-given interval
+# instead of each one retrying blind.
+_tg_pause_until = 0.0
+_TG_MAX_RETRIES = 5
+
+async def _tg(coro_fn, *args, **kwargs):
+    """Calls a bot method, honoring RetryAfter with a shared global backoff."""
+    global _tg_pause_until
+    for attempt in range(_TG_MAX_RETRIES):
+        wait = _tg_pause_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            return await coro_fn(*args, **kwargs)
+        except RetryAfter as e:
+            logger.warning("Telegram rate limit hit (%s), backing off %ss (attempt %s/%s).", getattr(coro_fn, '__name__', coro_fn), e.retry_after, attempt + 1, _TG_MAX_RETRIES)
+            _tg_pause_until = time.monotonic() + e.retry_after
+    # Out of retries: let the final attempt's outcome propagate to the caller.
+    return await coro_fn(*args, **kwargs)
+
+# Fire-and-forget tasks need a live reference until done, or the loop may GC
+# them before they run; the done-callback also retrieves their exception so a
+# routine failure (e.g. answering a stale callback) never becomes an unhandled
+# "Task exception was never retrieved" log.
+_background_tasks = set()
+
+def _fire_and_forget(coro, description):
+    """Runs coro as a task whose failure is logged instead of raised."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    def _done(t):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.warning("Background task (%s) failed: %s", description, t.exception())
+    task.add_done_callback(_done)
+
+async def _report_error(context, chat_id, message_id, text):
+    """Surfaces a failure to the user: edits the status message in place, and
+    only if that edit itself fails sends one fresh message instead."""
+    # A queued status edit (e.g. '正在发送…') flushed after us would overwrite
+    # the error with stale text; drop it before editing directly.
+    edit_coalescer.discard(chat_id, message_id)
+    try:
+        return await _tg(context.bot.edit_message_text,
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=None
+        )
+    except Exception as edit_e:
+        logger.warning("[%s] Could not edit message %s to report an error (%s), sending a new message.", chat_id, message_id, edit_e)
+        try:
+            return await _tg(context.bot.send_message, chat_id=chat_id, text=text, parse_mode='Markdown')
+        except Exception as send_e:
+            logger.error("[%s] Failed to report error to user: %s", chat_id, send_e, exc_info=True)
+            return None
+
+# --- Per-chat download workers ---
+# Downloads run on per-chat worker tasks instead of inline in the callback
+# handler, so one chat's multi-minute transfer never stalls another chat's
+# updates. Jobs for the same chat stay strictly ordered through its queue.
+_chat_job_queues = {}
+_chat_workers = {}
+
+def _enqueue_download(chat_id, download_item, context):
+    """Hands a download job to the chat's worker task, starting it on first use."""
+    queue = _chat_job_queues.get(chat_id)
+    if queue is None:
+        queue = _chat_job_queues.setdefault(chat_id, asyncio.Queue())
+    worker = _chat_workers.get(chat_id)
+    if worker is None or worker.done():
+        _chat_workers[chat_id] = asyncio.create_task(_chat_download_worker(chat_id))
+    queue.put_nowait((download_item, context))
+
+async def _chat_download_worker(chat_id):
+    """Drains one chat's download jobs serially and refreshes its list after each."""
+    queue = _chat_job_queues[chat_id]
+    while True:
+        download_item, context = await queue.get()
+        try:
+            # Same lock the callback handler holds, so a job sees the session
+            # state exactly as the click that queued it left it.
+            async with _get_session_lock(chat_id):
+                await download_and_send_video(chat_id, download_item, context)
+                await list_downloads(chat_id, context)
+        except Exception as e:
+            logger.error("[%s] Download worker job failed: %s", chat_id, e, exc_info=True)
+        finally:
+            queue.task_done()
 
 # --- Telegram Bot Command Handlers ---
 
 async def start(update: Update, context):
     """Triggers when the user sends the /start command"""
-    await update.message.reply_text('你好！请发送一个或多个视频链接给我，我会尝试解析并添加到队列。您可以使用 /list 查看和选择要处理的项目。')
-
-async def list_downloads(chat_id, context, update_obj=None):
+    await _tg(update.message.reply_text, '你好！请发送一个或多个视频链接给我，我会尝试解析并添加到队列。您可以使用 /list 查看和选择要处理的项目。')
+
+async def list_command(update: Update, context):
+    """Triggers when the user sends the /list command"""
+    # list_downloads mutates the session, so serialize with the other handlers.
+    async with _get_session_lock(update.effective_chat.id):
+        await list_downloads(update.effective_chat.id, context, update_obj=update)
+
+# Status display tables for list_downloads: one dict lookup per item instead of
+# an if/elif chain that re-checks item.get('status') per branch.
+_STATUS_PREFIX = {
+    'parse_failed': '❌ [解析失败] ',
+    'pending': '✅ ',
+    'failed_last_attempt': '⚠️ [下载失败] ',
+    'downloading': '⬇️ [下载中] ',
+    'sending': '⬆️ [发送中] ',
+}
+# status -> (button label, callback prefix); None prefix means a no-op button.
+_STATUS_BUTTON = {
+    'pending': ('下载', 'start_download'),
+    'failed_last_attempt': ('下载', 'start_download'),
+    'parse_failed': ('重解析', 'reparse_item'),
+}
+
+async def list_downloads(chat_id, context, update_obj=None, edit_message_id=None):
     """
     Displays current tasks and queue, and provides selection buttons.
     chat_id is now explicitly passed.
     update_obj is the original Update object (can be Message or CallbackQuery)
+    edit_message_id, if given, reuses that message for the list instead of
+    sending a new one (one API call instead of an ack edit plus a send).
     """
     session = user_download_sessions.get(chat_id)
-    
+    # Mutations below only mark the session dirty; a single save at the end (or
+    # before an early return) persists them all, instead of one save per mutation.
+    dirty = False
+
     # Load session data if not already loaded (e.g., bot restart)
     if not session:
-        session = load_user_session(chat_id)
+        session = await load_user_session(chat_id)
         if session:
             user_download_sessions[chat_id] = session
         else: # No session data found or corrupted
             user_download_sessions[chat_id] = {
                 'active_download': None,
-                'queue': [],
+                'queue': {},
+                'url_index': {},
                 'last_user_message_id': None,
                 'selection_buttons_message_id': None
             }
             session = user_download_sessions[chat_id]
-            save_user_session(chat_id, session) # Save initialized session
+            dirty = True # Save initialized session
 
-    # Delete previous selection buttons message if it exists
-    if session['selection_buttons_message_id']:
+    # Delete previous selection buttons message if it exists (unless it is the
+    # very message the new list is about to be edited into)
+    if session['selection_buttons_message_id'] and session['selection_buttons_message_id'] != edit_message_id:
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=session['selection_buttons_message_id'])
+            await _tg(context.bot.delete_message, chat_id=chat_id, message_id=session['selection_buttons_message_id'])
             session['selection_buttons_message_id'] = None
-            save_user_session(chat_id, session)
+            dirty = True
         except Exception as e:
-            logger.warning(f"[{chat_id}] Failed to delete old selection buttons message (list_downloads): {e}")
+            logger.warning("[%s] Failed to delete old selection buttons message (list_downloads): %s", chat_id, e)
 
     response_text = "当前视频处理队列：\n\n"
     keyboard = []
@@ -199,17 +775,14 @@ async def list_downloads(chat_id, context, update_obj=None):
     # So, we should clear active_download and ensure it's only in the queue for display/removal.
     if session.get('active_download'):
         if session['active_download']['status'] in ['parse_failed', 'failed_last_attempt']:
-            # Find this item in the queue and update its status if it exists, otherwise add it.
-            found_in_queue = False
-            for idx, q_item in enumerate(session['queue']):
-                if q_item.get('unique_id') == session['active_download'].get('unique_id'):
-                    session['queue'][idx]['status'] = session['active_download']['status']
-                    found_in_queue = True
-                    break
-            if not found_in_queue:
-                session['queue'].append(session['active_download'])
+            # Update this item's status in the queue if it exists, otherwise add it.
+            active_uid = session['active_download'].get('unique_id')
+            if active_uid in session['queue']:
+                session['queue'][active_uid]['status'] = session['active_download']['status']
+            else:
+                _queue_add(session, session['active_download'])
             session['active_download'] = None # Clear active_download, as it's now 'managed' by the queue
-            save_user_session(chat_id, session) # Save this state change
+            dirty = True
             # After this, the item will be picked up by the filtered_queue logic below.
         else: # It's genuinely active (downloading, sending, awaiting_quality_selection)
             active_item = session['active_download'].copy() # Make a copy
@@ -219,76 +792,55 @@ async def list_downloads(chat_id, context, update_obj=None):
     # The fix for "重复显示在列表" is primarily ensuring that parse_failed items that are *not* the active download
     # are handled correctly (i.e., can be re-parsed or removed).
     filtered_queue = [
-        item for item in session['queue'] 
+        item for item in session['queue'].values()
         if item['status'] not in ['completed', 'cancelled', 'failed', 'failed_sending', 'failed_internal']
     ]
     display_items.extend(filtered_queue)
 
 
     if not display_items:
+        if dirty:
+            save_user_session(chat_id, session)
         # Use update_obj to reply if it's a new message, otherwise send a new message
-        if update_obj and hasattr(update_obj, 'message') and update_obj.message:
-            await update_obj.message.reply_text("当前没有正在处理或排队的视频。")
+        if edit_message_id:
+            await _tg(context.bot.edit_message_text, chat_id=chat_id, message_id=edit_message_id,
+                      text="当前没有正在处理或排队的视频。", reply_markup=None)
+        elif update_obj and hasattr(update_obj, 'message') and update_obj.message:
+            await _tg(update_obj.message.reply_text, "当前没有正在处理或排队的视频。")
         else:
-            await context.bot.send_message(chat_id=chat_id, text="当前没有正在处理或排队的视频。")
+            await _tg(context.bot.send_message, chat_id=chat_id, text="当前没有正在处理或排队的视频。")
         return
 
-    # Create rows of three number buttons, now with `start_download` or `reparse_item` callback
-    current_row = []
+    # Collect all buttons in a flat list; they are chunked into rows of three below.
+    buttons = []
     for i, item in enumerate(display_items):
         display_title = item.get('title', '未知视频')
-        
+
         # Prepend emojis based on status
-        if item.get('status') == 'parse_failed':
-            display_title = f"❌ [解析失败] {display_title}" # X emoji for parse failed
-        elif item.get('status') == 'pending':
-            display_title = f"✅ {display_title}" # Checkmark emoji for pending
-        elif item.get('status') == 'failed_last_attempt':
-            display_title = f"⚠️ [下载失败] {display_title}" # Warning emoji for failed last attempt
-        elif item.get('status') == 'downloading':
-            display_title = f"⬇️ [下载中] {display_title}" # Down arrow for downloading
-        elif item.get('status') == 'sending':
-            display_title = f"⬆️ [发送中] {display_title}" # Up arrow for sending
+        status_prefix = _STATUS_PREFIX.get(item.get('status'))
+        if status_prefix is not None:
+            display_title = status_prefix + display_title
         elif display_title == '未知视频' or not display_title or display_title == '[解析中]':
             display_title = f"🔍 [解析中] {item.get('url', '链接')}"
-        
-        status_info = f" ({item.get('status', '待处理')})" # Keep status for debug, but emoji makes it clear
-        response_text += f"**{i+1}.** `{display_title}`\n" # Removed status_info here
-
-        # Determine callback data based on item status
-        callback_data_for_button = f'_no_op_dummy_{i}' # Default to dummy
-
-        # Only allow starting download if pending or failed_last_attempt
-        # Add a remove option for failed items
-        if item['status'] in ['pending', 'failed_last_attempt']:
-            callback_data_for_button = f'start_download_{item["unique_id"]}'
-            current_row.append(InlineKeyboardButton(f"下载 {i+1}", callback_data=callback_data_for_button))
-        elif item['status'] == 'parse_failed':
-            callback_data_for_button = f'reparse_item_{item["unique_id"]}' # New callback for re-parsing
-            current_row.append(InlineKeyboardButton(f"重解析 {i+1}", callback_data=callback_data_for_button))
-        else: # For downloading, sending, etc. display just a number button that does nothing
-            current_row.append(InlineKeyboardButton(f"查看 {i+1}", callback_data=callback_data_for_button))
-        
+
+        response_text += f"**{i+1}.** `{display_title}`\n"
+
+        # Determine button label and callback data based on item status:
+        # pending/failed_last_attempt start a download, parse_failed re-parses,
+        # anything else (downloading, sending, ...) gets a no-op number button.
+        button_label, callback_prefix = _STATUS_BUTTON.get(item['status'], ('查看', None))
+        if callback_prefix:
+            callback_data_for_button = f'{callback_prefix}_{item["unique_id"]}'
+        else:
+            callback_data_for_button = f'_no_op_dummy_{i}'
+        buttons.append(InlineKeyboardButton(f"{button_label} {i+1}", callback_data=callback_data_for_button))
+
         # Add a "Remove" button for failed or parse_failed items (regardless of active_download status, as it's now in queue)
         if item['status'] in ['parse_failed', 'failed_last_attempt']:
-            current_row.append(InlineKeyboardButton(f"移除 {i+1}", callback_data=f'remove_item_{item["unique_id"]}'))
-
-
-        if len(current_row) >= 2 and i == len(display_items) -1: # Ensure we have at least 2 buttons per row before adding a new row
-             keyboard.append(current_row)
-             current_row = []
-        elif len(current_row) == 2: # Keep 2 columns if not mixed, or adjust to 3 for number + remove
-            keyboard.append(current_row)
-            current_row = []
-        elif len(current_row) == 3: # 3 columns per row
-            keyboard.append(current_row)
-            current_row = []
-    
-    # Pad the last row with empty buttons if it's not full, to maintain layout
-    while len(current_row) > 0 and len(current_row) < 3: # Only pad if there are buttons in the row
-        current_row.append(InlineKeyboardButton(" ", callback_data='_no_op'))
-    if current_row: # Add any remaining buttons (including padded ones) in the last row
-        keyboard.append(current_row)
+            buttons.append(InlineKeyboardButton(f"移除 {i+1}", callback_data=f'remove_item_{item["unique_id"]}'))
+
+    # Chunk the flat button list into rows of three in one pass.
+    keyboard.extend(buttons[row_start:row_start + 3] for row_start in range(0, len(buttons), 3))
 
 
     # Add clear all button if there are any items
@@ -297,62 +849,144 @@ async def list_downloads(chat_id, context, update_obj=None):
 
     reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
 
-    # Send a new message with the updated list and buttons
-    message_sent = await context.bot.send_message(
-        chat_id=chat_id,
-        text=response_text,
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
-    session['selection_buttons_message_id'] = message_sent.message_id
+    # Reuse the caller's message when given, otherwise send a new one
+    if edit_message_id:
+        await _tg(context.bot.edit_message_text,
+            chat_id=chat_id,
+            message_id=edit_message_id,
+            text=response_text,
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+        session['selection_buttons_message_id'] = edit_message_id
+    else:
+        message_sent = await _tg(context.bot.send_message,
+            chat_id=chat_id,
+            text=response_text,
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+        session['selection_buttons_message_id'] = message_sent.message_id
     save_user_session(chat_id, session)
-    logger.info(f"[{chat_id}] Displayed '/list' command queue and selection buttons.")
+    logger.info("[%s] Displayed '/list' command queue and selection buttons.", chat_id)
 
 
 async def _send_media_file(chat_id, file_path, video_title, send_as_video, context, thumbnail_path=None, video_width=None, video_height=None, caption_prefix=''):
     """
     Generic helper function to send video or file to a specified chat_id.
     Does not include message editing or deletion logic.
+    Returns the sent Message on success (so callers can copy_message it), None on failure.
     """
+    media_file = None
+    thumbnail_file = None
     try:
-        with open(file_path, 'rb') as media_file:
-            logger.info(f"[{chat_id}] Opening file {file_path} for sending to target chatinien...")
-            
-            caption = f'{caption_prefix}视频：{video_title}' if send_as_video else f'{caption_prefix}文件：{video_title}'
+        caption = f'{caption_prefix}视频：{video_title}' if send_as_video else f'{caption_prefix}文件：{video_title}'
 
-            if send_as_video:
-                thumbnail_file = None
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    thumbnail_file = open(thumbnail_path, 'rb')
-                    logger.info(f"[{chat_id}] Using thumbnail: {thumbnail_path}")
+        if TELEGRAM_BOT_API_BASE_URL:
+            # A local Bot API server reads the file from disk itself, so passing the
+            # path avoids pushing the whole file through an HTTP multipart upload.
+            media_input = file_path
+        else:
+            logger.info("[%s] Opening file %s for sending to target chatinien...", chat_id, file_path)
+            # open() can block on slow/remote filesystems; keep it off the loop.
+            media_file = await asyncio.to_thread(open, file_path, 'rb')
+            # read_file_handle=False hands the open handle to the HTTP layer so the
+            # multipart body is streamed chunk by chunk instead of slurping the whole
+            # (potentially multi-GB) file into memory first.
+            media_input = InputFile(media_file, filename=os.path.basename(file_path), read_file_handle=False)
+
+        if send_as_video:
+            thumbnail_input = None
+            if thumbnail_path and await asyncio.to_thread(os.path.exists, thumbnail_path):
+                if TELEGRAM_BOT_API_BASE_URL:
+                    thumbnail_input = thumbnail_path
+                else:
+                    thumbnail_file = await asyncio.to_thread(open, thumbnail_path, 'rb')
+                    thumbnail_input = thumbnail_file
+                logger.info("[%s] Using thumbnail: %s", chat_id, thumbnail_path)
 
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=media_file,
-                    caption=caption,
-                    thumbnail=thumbnail_file,
-                    supports_streaming=True,
-                    width=video_width,
-                    height=video_height
-                )
-                if thumbnail_file:
-                    thumbnail_file.close()
-                logger.info(f"[{chat_id}] Video sent via Telegram API send_video to {chat_id}.")
-            else:
-                await context.bot.send_document(
-                    chat_id=chat_id,
-                    document=media_file,
-                    filename=os.path.basename(file_path),
-                    caption=caption,
-                )
-                logger.info(f"[{chat_id}] Video sent via Telegram API send_document to {chat_id}.")
-            
-        return True
+            sent_message = await _tg(context.bot.send_video,
+                chat_id=chat_id,
+                video=media_input,
+                caption=caption,
+                thumbnail=thumbnail_input,
+                supports_streaming=True,
+                width=video_width,
+                height=video_height
+            )
+            logger.info("[%s] Video sent via Telegram API send_video to %s.", chat_id, chat_id)
+        else:
+            sent_message = await _tg(context.bot.send_document,
+                chat_id=chat_id,
+                document=media_input,
+                caption=caption,
+            )
+            logger.info("[%s] Video sent via Telegram API send_document to %s.", chat_id, chat_id)
+
+        return sent_message
 
     except Exception as e:
-        logger.error(f"[{chat_id}] Error sending file to Telegram: {e}", exc_info=True)
+        logger.error("[%s] Error sending file to Telegram: %s", chat_id, e, exc_info=True)
+        return None
+    finally:
+        if thumbnail_file:
+            thumbnail_file.close()
+        if media_file:
+            media_file.close()
+
+# Quality-selection keyboard shown when a video is too large; identical for
+# every video, so it is built once at import instead of per request.
+_QUALITY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("尝试中等质量 (720p/480p)", callback_data='quality_medium')],
+    [InlineKeyboardButton("尝试最低质量 (144p)", callback_data='quality_lowest')],
+    [InlineKeyboardButton("保存到列表", callback_data='save_to_list')],
+    [InlineKeyboardButton("取消", callback_data='cancel_download')]
+])
+
+async def _async_unlink(path):
+    """Removes a file without blocking the event loop. Returns True if it was deleted.
+
+    Attempts the unlink directly instead of stat-ing first; a missing file is
+    not an error, saving a syscall per cleanup.
+    """
+    try:
+        await asyncio.to_thread(os.remove, path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as os_err:
+        logger.error("OS error deleting file %s: %s", path, os_err)
         return False
 
+# Terminal statuses whose items leave the queue when a download run ends.
+REMOVE_STATUSES = frozenset({'completed', 'cancelled', 'failed', 'failed_sending', 'failed_internal'})
+
+# Size-gating decision shared by the pre-download estimate check and the
+# post-download actual-size check, so both stages use one set of thresholds.
+# action is None (proceed), 'select' (offer the quality keyboard) or 'reject'
+# (over the hard upload limit).
+_SizeDecision = collections.namedtuple('_SizeDecision', ['send_as_video', 'action', 'message'])
+
+def _classify_size(size, format_string, video_title, actual=False):
+    """Maps a file size onto a send/gate decision and its user-facing message."""
+    if size is None: # Only happens pre-download, when the probe has no estimate
+        return _SizeDecision(False, None, f'找到视频：**{video_title}**，但无法预估文件大小。将尝试下载，并根据实际大小决定是否提供清晰度选项，请稍候...')
+    if size > TELEGRAM_MAX_FILE_SIZE_BYTES:
+        size_desc = '实际' if actual else '(当前选择的清晰度) 预估'
+        message = f'视频 **{video_title}** {size_desc}大小约为 {size / (1000 * 1000 * 1000):.2f}GB，超出 Telegram {TELEGRAM_MAX_FILE_SIZE_BYTES / (1000 * 1000 * 1000):.2f}GB Upload limit, cannot process.'
+        # The estimate may be off, so before the download users still get the
+        # quality options; afterwards the size is final and the item fails.
+        return _SizeDecision(False, 'reject' if actual else 'select', message)
+    if size <= TELEGRAM_VIDEO_FILE_SIZE_LIMIT_BYTES:
+        return _SizeDecision(True, None, f'找到视频：**{video_title}** (大小: {size / (1024 * 1024):.2f}MB)，开始下载...')
+    # Between 50MB and the hard limit.
+    if actual:
+        return _SizeDecision(False, 'select', f'视频 **{video_title}** 实际大小为 {size / (1024 * 1024):.2f}MB，超过 50MB，需要您选择其他清晰度，或将其保存到列表后续处理。')
+    if format_string == 'best': # Only offer selection if 'best' was originally attempted and it's too large
+        return _SizeDecision(False, 'select', f'视频 **{video_title}** 预估大小约为 {size / (1024 * 1024):.2f}MB。文件较大，请选择清晰度以尝试下载。')
+    # User already selected a quality, just download
+    return _SizeDecision(False, None, f'找到视频：**{video_title}** (大小: {size / (1024 * 1024):.2f}MB)，开始下载...')
+
 async def download_and_send_video(chat_id, download_item: dict, context):
     """
     Core logic for downloading and sending videos.
@@ -370,18 +1004,18 @@ async def download_and_send_video(chat_id, download_item: dict, context):
     
     session = user_download_sessions.get(chat_id)
     if not session: # This should ideally not happen if session is loaded properly
-        logger.error(f"[{chat_id}] download_and_send_video: Session lost. Aborting.")
+        logger.error("[%s] download_and_send_video: Session lost. Aborting.", chat_id)
         return False
 
-    # IMPORTANT: Ensure active_download matches the item being processed
-    # This prevents issues if a new request comes in and replaces active_download
-    # or if the user clicks cancel while a download is in progress.
-    if session.get('active_download') and session.get('active_download').get('unique_id') != download_item.get('unique_id'):
-        logger.warning(f"[{chat_id}] download_and_send_video called, but download item is not current active item or session updated. Aborting.")
-        # Attempt to set the item's status in the queue to failed if it can be found
-        # MODIFICATION: Ensure if active_download doesn't match, it means it was superseded, so mark this one as failed_internal and remove from queue
-        # Find and remove the mismatched item if it exists in the queue
-        session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != download_item.get('unique_id')]
+    # IMPORTANT: Ensure active_download matches the item being processed.
+    # Jobs run on deferred worker tasks, so by the time the worker gets the
+    # chat lock a clear_all/remove_item callback may have cleared or replaced
+    # active_download; a cleared one means the user no longer wants this item.
+    if not session.get('active_download') or session['active_download'].get('unique_id') != download_item.get('unique_id'):
+        logger.warning("[%s] download_and_send_video called, but download item is no longer the active item. Aborting.", chat_id)
+        # The item was superseded or withdrawn; drop it from the queue if it is
+        # still there so it cannot be dispatched again.
+        _queue_pop(session, download_item.get('unique_id'))
         save_user_session(chat_id, session)
         return False
 
@@ -390,368 +1024,267 @@ async def download_and_send_video(chat_id, download_item: dict, context):
 
     try:
         os.makedirs(DOWNLOAD_DESTINATION_DIR, exist_ok=True)
-        logger.info(f"[{chat_id}] Ensuring '{DOWNLOAD_DESTINATION_DIR}' folder exists.")
+        logger.info("[%s] Ensuring '%s' folder exists.", chat_id, DOWNLOAD_DESTINATION_DIR)
 
-        # First, try to get info without downloading to check size and set initial message
-        ydl_opts_info = {
+        # A single extract_info drives title display, size gating and the download:
+        # the download phase below reuses this instance and info dict via
+        # process_ie_result instead of running the extractor a second time.
+        ydl_opts_download = {
+            **YDL_OPTS_COMMON,
             'format': format_string,
-            'noplaylist': True,
-            'restrictfilenames': True,
-            'nocheckcertificate': True,
-            'quiet': True,
-            'no_warnings': True,
-            'simulate': True,
-            'getfilename': True,
-            'geturl': True,
-            'forcetitle': True,
-            'forcefilename': True,
+            'outtmpl': os.path.join(DOWNLOAD_DESTINATION_DIR, '%(title)s.%(ext)s'),
+            'progress_hooks': [yt_dlp_progress_hook],
         }
 
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl_info:
-            logger.info(f"[{chat_id}] Attempting to get video info (format: {format_string})..")
-            
-            info_dict = ydl_info.extract_info(url, download=False)
-            # Update video_title in case the initial one was '[解析中]' or less accurate
-            video_title = info_dict.get('title', video_title)
-            file_size_initial_estimate = info_dict.get('filesize') or info_dict.get('filesize_approx')
-            
-            # Update session's active_download title
-            session['active_download']['title'] = video_title
-            save_user_session(chat_id, session) # Save updated title
-
-            logger.info(f"[{chat_id}] Video title: {video_title}, Estimated file size: {file_size_initial_estimate} bytes (format: {format_string})")
-
-            message_to_edit = ""
-            action_needed = False # Flag to indicate if quality selection is needed
-
-            if file_size_initial_estimate is None:
-                message_to_edit = f'找到视频：**{video_title}**，但无法预估文件大小。将尝试下载，并根据实际大小决定是否提供清晰度选项，请稍候...'
-                logger.warning(f"[{chat_id}] Failed to get file size for video {video_title}. Attempting download and will decide sending method based on actual size.")
-            elif file_size_initial_estimate > TELEGRAM_MAX_FILE_SIZE_BYTES:
-                message_to_edit = f'视频 **{video_title}** (当前选择的清晰度) 预估大小约为 {file_size_initial_estimate / (1000 * 1000 * 1000):.2f}GB，超出 Telegram {TELEGRAM_MAX_FILE_SIZE_BYTES / (1000 * 1000 * 1000):.2f}GB Upload limit, cannot process.'
-                logger.info(f"[{chat_id}] Video {video_title} (size: {file_size_initial_estimate}) exceeds Telegram limit, not downloading.")
-                action_needed = True # Still offer options if possible
-            elif file_size_initial_estimate <= TELEGRAM_VIDEO_FILE_SIZE_LIMIT_BYTES:
-                send_as_video = True
-                message_to_edit = f'找到视频：**{video_title}** (大小: {file_size_initial_estimate / (1024 * 1024):.2f}MB)，开始下载...'
-                logger.info(f"[{chat_id}] Video {video_title} (size: {file_size_initial_estimate}) is expected to be sent as video.")
-            else: # Greater than 50MB and less than 2GB, needs selection unless already trying specific format
-                if format_string == 'best': # Only offer selection if 'best' was originally attempted and it's too large
-                    message_to_edit = f'视频 **{video_title}** 预估大小约为 {file_size_initial_estimate / (1024 * 1024):.2f}MB。文件较大，请选择清晰度以尝试下载。'
-                    action_needed = True # Flag to show quality selection buttons
-                    logger.info(f"[{chat_id}] Video {video_title} (size: {file_size_initial_estimate}) is estimated to be larger than 50MB, will offer quality selection.")
-                else: # User already selected a quality, just download
-                    message_to_edit = f'找到视频：**{video_title}** (大小: {file_size_initial_estimate / (1024 * 1024):.2f}MB)，开始下载...'
-                    logger.info(f"[{chat_id}] Video {video_title} (size: {file_size_initial_estimate}) is estimated to be larger than 50MB, but specific quality selected, continuing download.")
-
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=initial_message_id,
-                text=message_to_edit,
-                parse_mode='Markdown'
+        ydl_download_key = _freeze_opts(ydl_opts_download)
+        # Keyed by chat so chats sharing a format string land on different
+        # slots and one chat's transfer never blocks another's probe.
+        download_slot = chat_id % DOWNLOAD_POOL_SIZE
+        logger.info("[%s] Attempting to get video info (format: %s)..", chat_id, format_string)
+
+        async with _get_ydl_lock(ydl_download_key, download_slot):
+            # Resolved under the lock so an instance retired by a previous
+            # holder of this slot is never picked up.
+            ydl_download = _get_ydl(ydl_download_key, download_slot)
+            info_dict = await asyncio.to_thread(ydl_download.extract_info, url, False)
+        # Update video_title in case the initial one was '[解析中]' or less accurate
+        video_title = info_dict.get('title', video_title)
+        file_size_initial_estimate = info_dict.get('filesize') or info_dict.get('filesize_approx')
+
+        # Update session's active_download title
+        session['active_download']['title'] = video_title
+
+        logger.info("[%s] Video title: %s, Estimated file size: %s bytes (format: %s)", chat_id, video_title, file_size_initial_estimate, format_string)
+
+        estimate_decision = _classify_size(file_size_initial_estimate, format_string, video_title)
+        send_as_video = estimate_decision.send_as_video
+        message_to_edit = estimate_decision.message
+        action_needed = estimate_decision.action == 'select' # Flag to indicate if quality selection is needed
+        logger.info("[%s] Size gate for %s (estimate: %s, format: %s): send_as_video=%s, action=%s", chat_id, video_title, file_size_initial_estimate, format_string, send_as_video, estimate_decision.action)
+
+        # Coalesced: when quality selection is needed the keyboard edit below
+        # supersedes this one before anything is sent, so only one edit goes out.
+        edit_coalescer.schedule(
+            context.bot, chat_id, initial_message_id,
+            text=message_to_edit,
+            parse_mode='Markdown'
+        )
+
+        if action_needed: # If quality selection is needed
+            edit_coalescer.schedule(
+                context.bot, chat_id, initial_message_id,
+                text=message_to_edit, # Re-use or refine message
+                parse_mode='Markdown',
+                reply_markup=_QUALITY_KEYBOARD
             )
+            session['active_download']['status'] = 'awaiting_quality_selection'
+            return False # Indicate that further action is needed from user
+
+        # Proceed with actual download, feeding the probe's info dict back in
+        logger.info("[%s] Preparing to download (format: %s).", chat_id, format_string)
+
+        finished_download = {} # Filled by the progress hook via _run_download
+        async with _get_ydl_lock(ydl_download_key, download_slot):
+            ydl_download = _get_ydl(ydl_download_key, download_slot)
+            try:
+                info_dict_after_download = await asyncio.wait_for(
+                    asyncio.to_thread(_run_download, ydl_download, info_dict, finished_download),
+                    timeout=300 # 5 minutes timeout for download
+                )
+                logger.info("[%s] yt-dlp download completed.", chat_id)
+            except asyncio.TimeoutError:
+                error_msg = f"下载超时 (5分钟)。"
+                logger.error("[%s] Download of %s timed out.", chat_id, url, exc_info=True)
+                # The to_thread worker cannot be cancelled and may still be
+                # driving this instance; retire it so no retry ever shares it.
+                _retire_ydl(ydl_download_key, download_slot)
+                session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
+                await _report_error(context, chat_id, initial_message_id, error_msg)
+                return False
+            except yt_dlp.utils.DownloadError as de:
+                error_msg = f"视频下载失败：`{de}`\n请检查链接是否有效、视频是否存在，或稍后再试。"
+                logger.error("[%s] yt-dlp download error: %s", chat_id, de, exc_info=True)
+                session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
+                await _report_error(context, chat_id, initial_message_id, error_msg)
+                return False
+            except Exception as e:
+                error_msg = f'下载时发生未知错误：`{e}`\n请联系管理员或稍后再试。'
+                logger.error("[%s] Unknown error during download of %s: %s", chat_id, url, e, exc_info=True)
+                session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
+                await _report_error(context, chat_id, initial_message_id, error_msg)
+                return False
 
-            if action_needed: # If quality selection is needed
-                keyboard = [
-                    [InlineKeyboardButton("尝试中等质量 (720p/480p)", callback_data='quality_medium')],
-                    [InlineKeyboardButton("尝试最低质量 (144p)", callback_data='quality_lowest')],
-                    [InlineKeyboardButton("保存到列表", callback_data='save_to_list')], # Add save to list
-                    [InlineKeyboardButton("取消", callback_data='cancel_download')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await context.bot.edit_message_text(
+
+            requested_downloads = info_dict_after_download.get('requested_downloads') or []
+            if requested_downloads:
+                final_file_path = requested_downloads[0].get('filepath')
+            else:
+                final_file_path = finished_download.get('filepath') or ydl_download.prepare_filename(info_dict_after_download)
+            logger.info("[%s] Final file path: %s", chat_id, final_file_path)
+            file_path = final_file_path
+
+        if await asyncio.to_thread(os.path.exists, file_path):
+            actual_file_size = await asyncio.to_thread(os.path.getsize, file_path)
+            logger.info("[%s] Actual downloaded file size: %s bytes", chat_id, actual_file_size)
+
+            actual_decision = _classify_size(actual_file_size, format_string, video_title, actual=True)
+            if actual_decision.action == 'reject':
+                session['active_download']['status'] = 'failed' # Permanently failed due to size
+                await _tg(context.bot.edit_message_text,
                     chat_id=chat_id,
                     message_id=initial_message_id,
-                    text=message_to_edit, # Re-use or refine message
+                    text=actual_decision.message,
                     parse_mode='Markdown',
-                    reply_markup=reply_markup
+                    reply_markup=None
                 )
+                return False
+            elif actual_decision.action == 'select':
+                # Even if it was <=50MB estimate, if actual size >50MB, offer quality selection or save to list
                 session['active_download']['status'] = 'awaiting_quality_selection'
-                save_user_session(chat_id, session) # Save status update
-                return False # Indicate that further action is needed from user
-
-            # Proceed with actual download
-            ydl_opts_download = {
-                'format': format_string,
-                'outtmpl': os.path.join(DOWNLOAD_DESTINATION_DIR, '%(title)s.%(ext)s'),
-                'noplaylist': True,
-                'restrictfilenames': True,
-                'nocheckcertificate': True,
-                'quiet': True,
-                'no_warnings': True,
-                'progress_hooks': [yt_dlp_progress_hook],
-            }
+                await _tg(context.bot.edit_message_text,
+                    chat_id=chat_id,
+                    message_id=initial_message_id,
+                    text=actual_decision.message,
+                    parse_mode='Markdown',
+                    reply_markup=_QUALITY_KEYBOARD
+                )
+                return False
+            else:
+                send_as_video = actual_decision.send_as_video # Within the 50MB video limit
 
-            with yt_dlp.YoutubeDL(ydl_opts_download) as ydl_download:
-                logger.info(f"[{chat_id}] Preparing to download (format: {format_string}).")
-                
-                try:
-                    await asyncio.wait_for(
-                        asyncio.to_thread(ydl_download.download, [url]),
-                        timeout=300 # 5 minutes timeout for download
-                    )
-                    logger.info(f"[{chat_id}] yt-dlp download completed.")
-                except asyncio.TimeoutError:
-                    error_msg = f"下载超时 (5分钟)。"
-                    logger.error(f"[{chat_id}] Download of {url} timed out.", exc_info=True)
-                    session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
-                    save_user_session(chat_id, session)
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=initial_message_id,
-                        text=error_msg,
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                    return False
-                except yt_dlp.utils.DownloadError as de:
-                    error_msg = f"视频下载失败：`{de}`\n请检查链接是否有效、视频是否存在，或稍后再试。"
-                    logger.error(f"[{chat_id}] yt-dlp download error: {de}", exc_info=True)
-                    session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
-                    save_user_session(chat_id, session)
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=initial_message_id,
-                        text=error_msg,
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                    return False
-                except Exception as e:
-                    error_msg = f'下载时发生未知错误：`{e}`\n请联系管理员或稍后再试。'
-                    logger.error(f"[{chat_id}] Unknown error during download of {url}: {e}", exc_info=True)
-                    session['active_download']['status'] = 'failed_last_attempt' # Mark as failed_last_attempt
-                    save_user_session(chat_id, session)
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=initial_message_id,
-                        text=error_msg,
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                    return False
-
-
-                info_dict_after_download = ydl_download.extract_info(url, download=False) 
-                final_file_path = ydl_download.prepare_filename(info_dict_after_download)
-                logger.info(f"[{chat_id}] Final file path: {final_file_path}")
-                file_path = final_file_path
-
-            if os.path.exists(file_path):
-                actual_file_size = os.path.getsize(file_path)
-                logger.info(f"[{chat_id}] Actual downloaded file size: {actual_file_size} bytes")
-
-                if actual_file_size > TELEGRAM_MAX_FILE_SIZE_BYTES:
-                    session['active_download']['status'] = 'failed' # Permanently failed due to size
-                    save_user_session(chat_id, session)
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=initial_message_id,
-                        text=f'视频 **{video_title}** 实际大小约为 {actual_file_size / (1000 * 1000 * 1000):.2f}GB，超出 Telegram {TELEGRAM_MAX_FILE_SIZE_BYTES / (1000 * 1000 * 1000):.2f}GB Upload limit, cannot process.', # FIXED: Escaped single quote
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                    return False
-                elif actual_file_size > TELEGRAM_VIDEO_FILE_SIZE_LIMIT_BYTES:
-                    # Even if it was <=50MB estimate, if actual size >50MB, offer quality selection or save to list
-                    session['active_download']['status'] = 'awaiting_quality_selection'
-                    save_user_session(chat_id, session) # Save status update
-                    keyboard = [
-                        [InlineKeyboardButton("尝试中等质量 (720p/480p)", callback_data='quality_medium')],
-                        [InlineKeyboardButton("尝试最低质量 (144p)", callback_data='quality_lowest')],
-                        [InlineKeyboardButton("保存到列表", callback_data='save_to_list')], # Add save to list
-                        [InlineKeyboardButton("取消", callback_data='cancel_download')]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=initial_message_id,
-                        text=f'视频 **{video_title}** 实际大小为 {actual_file_size / (1024 * 1024):.2f}MB，超过 50MB，需要您选择其他清晰度，或将其保存到列表后续处理。',
-                        parse_mode='Markdown',
-                        reply_markup=reply_markup
-                    )
-                    return False
-                else:
-                    send_as_video = True # Ensure sending as video if within 50MB limit
+            video_width = info_dict_after_download.get('width') or finished_download.get('width')
+            video_height = info_dict_after_download.get('height') or finished_download.get('height')
 
-                video_width = info_dict_after_download.get('width')
-                video_height = info_dict_after_download.get('height')
-                
-                file_to_send = file_path 
-                logger.info(f"[{chat_id}] Skipping ffmpeg re-encoding/muxing, directly using original file: {file_to_send}")
+            file_to_send = file_path 
+            logger.info("[%s] Skipping ffmpeg re-encoding/muxing, directly using original file: %s", chat_id, file_to_send)
 
-                if send_as_video:
-                    thumbnail_path = os.path.join(DOWNLOAD_DESTINATION_DIR, f"{os.path.basename(file_path)}.jpg")
-                    success_thumbnail = await extract_thumbnail(file_to_send, thumbnail_path)
-                    if not success_thumbnail:
-                        thumbnail_path = None
+            if send_as_video:
+                thumbnail_path = await get_or_create_thumbnail(file_to_send, download_item.get('unique_id'))
 
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=initial_message_id,
-                    text='视频下载完成，正在发送到 Telegram...',
+            edit_coalescer.schedule(
+                context.bot, chat_id, initial_message_id,
+                text='视频下载完成，正在发送到 Telegram...',
+            )
+            session['active_download']['status'] = 'sending'
+
+            # Check if the download_item still matches active_download before sending
+            if session.get('active_download') and session.get('active_download').get('unique_id') != download_item.get('unique_id'):
+                logger.info("[%s] Download item was replaced or cancelled before sending. Aborting send.", chat_id)
+                return False
+
+            # --- Send to user first ---
+            user_message = await _send_media_file(chat_id, file_to_send, video_title, send_as_video, context, thumbnail_path, video_width, video_height)
+
+            if user_message:
+                # Edit the status message to its final state rather than deleting
+                # it: same UX outcome, one fewer API call against the per-chat
+                # rate budget, and the coalescer folds it into any pending edit.
+                edit_coalescer.schedule(
+                    context.bot, chat_id, initial_message_id,
+                    text=f'✅ 发送完成：**{video_title}**',
+                    parse_mode='Markdown'
                 )
-                session['active_download']['status'] = 'sending'
-                save_user_session(chat_id, session) # Save status update
-                
-                # Check if the download_item still matches active_download before sending
-                if session.get('active_download') and session.get('active_download').get('unique_id') != download_item.get('unique_id'):
-                    logger.info(f"[{chat_id}] Download item was replaced or cancelled before sending. Aborting send.")
-                    return False
-
-                # --- Send to user first ---
-                user_send_success = await _send_media_file(chat_id, file_to_send, video_title, send_as_video, context, thumbnail_path, video_width, video_height)
-                
-                if user_send_success:
-                    logger.info(f"[{chat_id}] File sent successfully. Attempting to delete initial status message ID: {initial_message_id}.")
-                    try:
-                        # Delete the status message that was being updated during download
-                        await context.bot.delete_message(chat_id=chat_id, message_id=initial_message_id)
-                        logger.info(f"[{chat_id}] Deleted initial status message (ID: {initial_message_id}).")
-                    except Exception as e:
-                        logger.warning(f"[{chat_id}] Failed to delete initial status message (ID: {initial_message_id}): {e}")
-
-                    # --- If user send successful, attempt to forward to channel ---
-                    if TELEGRAM_CHANNEL_ID:
-                        logger.info(f"[{chat_id}] Attempting to forward video to channel: {TELEGRAM_CHANNEL_ID}")
-                        try:
-                            # Re-open file for channel send, as user send might have consumed it
-                            channel_send_success = await _send_media_file(
-                                TELEGRAM_CHANNEL_ID,
-                                file_to_send,
-                                video_title,
-                                send_as_video,
-                                context,
-                                thumbnail_path,
-                                video_width,
-                                video_height,
-                                caption_prefix='[自动转发] ' # Add prefix for channel message
-                            )
-                            if channel_send_success:
-                                logger.info(f"[{chat_id}] Video successfully forwarded to channel: {TELEGRAM_CHANNEL_ID}")
-                            else:
-                                logger.warning(f"[{chat_id}] Video failed to forward to channel: {TELEGRAM_CHANNEL_ID}")
-                        except Exception as channel_e:
-                            logger.error(f"[{chat_id}] Error forwarding video to channel {TELEGRAM_CHANNEL_ID}时发生错误: {channel_e}", exc_info=True)
-                    else:
-                        logger.info(f"[{chat_id}] TELEGRAM_CHANNEL_ID is not set, skipping forwarding to channel.")
-
-                    session['active_download']['status'] = 'completed'
-                else: # User send failed
-                    session['active_download']['status'] = 'failed_sending'
-                    # If sending to user failed, edit message to reflect failure
+
+                # --- If user send successful, attempt to forward to channel ---
+                if TELEGRAM_CHANNEL_ID:
+                    logger.info("[%s] Attempting to forward video to channel: %s", chat_id, TELEGRAM_CHANNEL_ID)
                     try:
-                        await context.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=initial_message_id,
-                            text=f'发送文件到 Telegram 时发生错误：`{e}`\n您可以尝试重新发送链接，或选择其他清晰度。',
-                            parse_mode='Markdown'
+                        # copy_message reuses the file_id of the just-sent media
+                        # server-side, so the channel copy costs no second upload.
+                        await _tg(context.bot.copy_message,
+                            chat_id=TELEGRAM_CHANNEL_ID,
+                            from_chat_id=chat_id,
+                            message_id=user_message.message_id,
+                            caption=f'[自动转发] {"视频" if send_as_video else "文件"}：{video_title}'
                         )
-                    except Exception as edit_e:
-                        logger.error(f"[{chat_id}] Could not edit message {initial_message_id} to show send failure error: {edit_e}", exc_info=True)
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=f'发送文件到 Telegram 时发生错误：`{e}`\n您可以尝试重新发送链接，或选择其他清晰度。',
-                            parse_mode='Markdown'
+                        logger.info("[%s] Video successfully forwarded to channel: %s", chat_id, TELEGRAM_CHANNEL_ID)
+                    except Exception as channel_e:
+                        logger.error("[%s] Error copying video to channel %s, falling back to re-upload: %s", chat_id, TELEGRAM_CHANNEL_ID, channel_e, exc_info=True)
+                        channel_message = await _send_media_file(
+                            TELEGRAM_CHANNEL_ID,
+                            file_to_send,
+                            video_title,
+                            send_as_video,
+                            context,
+                            thumbnail_path,
+                            video_width,
+                            video_height,
+                            caption_prefix='[自动转发] ' # Add prefix for channel message
                         )
+                        if not channel_message:
+                            logger.warning("[%s] Video failed to forward to channel: %s", chat_id, TELEGRAM_CHANNEL_ID)
+                else:
+                    logger.info("[%s] TELEGRAM_CHANNEL_ID is not set, skipping forwarding to channel.", chat_id)
 
-                save_user_session(chat_id, session) # Save final status
-                return user_send_success
+                session['active_download']['status'] = 'completed'
+            else: # User send failed (the exception was logged in _send_media_file)
+                session['active_download']['status'] = 'failed_sending'
+                await _report_error(context, chat_id, initial_message_id,
+                                    '发送文件到 Telegram 时发生错误。\n您可以尝试重新发送链接，或选择其他清晰度。')
 
-            else:
-                session['active_download']['status'] = 'failed_last_attempt' # Treat as a retryable failed download
-                save_user_session(chat_id, session)
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=initial_message_id,
-                    text='下载失败：未能找到下载的视频文件，请重试或检查链接。',
-                    reply_markup=None
-                )
-                return False
+            return user_message is not None
+
+        else:
+            session['active_download']['status'] = 'failed_last_attempt' # Treat as a retryable failed download
+            await _report_error(context, chat_id, initial_message_id,
+                                '下载失败：未能找到下载的视频文件，请重试或检查链接。')
+            return False
 
     except yt_dlp.utils.DownloadError as de:
         error_msg = f"视频处理失败：`{de}`\n请检查链接是否有效、视频是否存在，或稍后再试。"
-        logger.error(f"[{chat_id}] yt-dlp download error: {de}", exc_info=True)
+        logger.error("[%s] yt-dlp download error: %s", chat_id, de, exc_info=True)
         session['active_download']['status'] = 'failed_last_attempt' # Mark as failed, but still retryable
-        save_user_session(chat_id, session)
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=initial_message_id,
-            text=error_msg,
-            parse_mode='Markdown',
-            reply_markup=None
-        )
+        await _report_error(context, chat_id, initial_message_id, error_msg)
         return False
             
     except Exception as e:
         error_msg = f'发生未知错误：`{e}`\n请联系管理员或稍后再试。'
-        logger.error(f"[{chat_id}] Unknown error while processing link {url}: {e}", exc_info=True)
+        logger.error("[%s] Unknown error while processing link %s: %s", chat_id, url, e, exc_info=True)
         session['active_download']['status'] = 'failed_last_attempt' # Mark as failed, but still retryable
-        save_user_session(chat_id, session)
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=initial_message_id,
-            text=error_msg,
-            parse_mode='Markdown',
-            reply_markup=None
-        )
+        await _report_error(context, chat_id, initial_message_id, error_msg)
         return False
     finally:
-        logger.info(f"[{chat_id}] Entering finally block.")
+        logger.info("[%s] Entering finally block.", chat_id)
         # Cleanup logic
-        if file_path and os.path.exists(file_path):
+        if file_path:
             if SHOULD_DELETE_FILE:
-                try:
-                    os.remove(file_path)
-                    logger.info(f"[{chat_id}] Finally block: Deleted local original file: {file_path}")
-                except OSError as os_err:
-                    logger.error(f"[{chat_id}] Finally block: OS error deleting original file {file_path}: {os_err}")
+                if await _async_unlink(file_path):
+                    logger.info("[%s] Finally block: Deleted local original file: %s", chat_id, file_path)
             else:
-                logger.info(f"[{chat_id}] Finally block: Keeping original file as per config: {file_path}")
+                logger.info("[%s] Finally block: Keeping original file as per config: %s", chat_id, file_path)
         
-        if thumbnail_path and os.path.exists(thumbnail_path):
-            try:
-                os.remove(thumbnail_path)
-            except OSError as os_err:
-                logger.error(f"[{chat_id}] Finally block: OS error deleting thumbnail file {thumbnail_path}: {os_err}")
+        # Thumbnails stay in THUMBNAIL_CACHE_DIR for reuse; _trim_thumbnail_cache
+        # evicts the oldest ones instead of deleting per send.
+
+        # Update queue status based on active_download result. Alias the item and
+        # its status once instead of re-resolving the nested chain per branch.
+        active_dl = session.get('active_download') if session else None
+        item_uid = download_item.get('unique_id')
+        if active_dl and active_dl.get('unique_id') == item_uid:
+            status = active_dl['status']
+            # Completed, cancelled and permanently failed items all leave the
+            # queue the same way; retryable failures are updated in place below.
+            if status in REMOVE_STATUSES:
+                _queue_pop(session, item_uid)
+                logger.info("[%s] Item %s (unique_id: %s) finished with status '%s', removed from queue.", chat_id, download_item.get('title'), item_uid, status)
+            elif status == 'parse_failed' or status == 'failed_last_attempt':
+                # If parse failed or last attempt failed, ensure it's in the queue (or updated) for re-parse/retry
+                if item_uid in session['queue']:
+                    session['queue'][item_uid]['status'] = status
+                else: # If not found in queue (e.g., direct download failed parsing), add it
+                    _queue_add(session, active_dl)
+                logger.info("[%s] Item %s (unique_id: %s) parsing/downloading failed, status updated in queue.", chat_id, download_item.get('title'), item_uid)
 
-        # Update queue status based on active_download result
-        if session and session.get('active_download') and session['active_download'].get('unique_id') == download_item.get('unique_id'):
-            
-            # If the active download was originally from the queue and it completed successfully, remove it.
-            if session['active_download']['status'] == 'completed':
-                # Remove the completed item from the queue
-                session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != download_item.get('unique_id')]
-                logger.info(f"[{chat_id}] Item {download_item.get('title')} (unique_id: {download_item.get('unique_id')}) successfully completed and removed from queue.")
-            elif session['active_download']['status'] == 'cancelled':
-                # Remove cancelled item from queue
-                session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != download_item.get('unique_id')]
-                logger.info(f"[{chat_id}] Item {download_item.get('title')} (unique_id: {download_item.get('unique_id')}) cancelled and removed from queue.")
-            # For permanent failures (failed, failed_sending, failed_internal), also remove from queue
-            elif session['active_download']['status'] in ['failed', 'failed_sending', 'failed_internal']:
-                logger.info(f"[{chat_id}] Item {download_item.get('title')} (unique_id: {download_item.get('unique_id')}) permanently failed, removing from queue.")
-                session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != download_item.get('unique_id')]
-            elif session['active_download']['status'] == 'parse_failed' or session['active_download']['status'] == 'failed_last_attempt':
-                 # If parse failed or last attempt failed, ensure it's in the queue (or updated) for re-parse/retry
-                found_in_queue = False
-                for idx, q_item in enumerate(session['queue']):
-                    if q_item.get('unique_id') == download_item.get('unique_id'):
-                        session['queue'][idx]['status'] = session['active_download']['status']
-                        found_in_queue = True
-                        break
-                if not found_in_queue: # If not found in queue (e.g., direct download failed parsing), add it
-                    session['queue'].append(session['active_download'])
-                logger.info(f"[{chat_id}] Item {download_item.get('title')} (unique_id: {download_item.get('unique_id')}) parsing/downloading failed, status updated in queue.")
-            
             # IMPORTANT FIX: Always clear active_download if it's no longer actively downloading/sending.
             # Only keep it active if it's truly awaiting user input (awaiting_quality_selection)
-            if session['active_download']['status'] not in ['awaiting_quality_selection']:
-                logger.info(f"[{chat_id}] Clearing active_download. Status was: {session['active_download'].get('status')}")
+            if status != 'awaiting_quality_selection':
+                logger.info("[%s] Clearing active_download. Status was: %s", chat_id, status)
                 session['active_download'] = None # Clear active download if finished or failed permanently
             else:
-                logger.info(f"[{chat_id}] Active download is {session['active_download'].get('status')}, keeping it active temporarily.")
+                logger.info("[%s] Active download is %s, keeping it active temporarily.", chat_id, status)
 
-        save_user_session(chat_id, session) # Save final session state
+        # Terminal transition: write through so the outcome survives a crash.
+        await save_user_session_now(chat_id, session)
 
 
 async def handle_video_link(update: Update, context):
@@ -760,444 +1293,467 @@ async def handle_video_link(update: Update, context):
     chat_id = update.message.chat_id
     last_user_message_id = update.message.message_id
 
-    # Load session data
-    session = user_download_sessions.get(chat_id)
-    if not session:
-        session = load_user_session(chat_id)
-        if session:
-            user_download_sessions[chat_id] = session
-        else:
+    # With concurrent update dispatch, two messages from the same chat can race
+    # a cache miss and each install a fresh session, losing the other's items;
+    # the scope serializes them (and the worker's queue mutations) per chat.
+    async with session_scope(chat_id) as session:
+        if not session:
             user_download_sessions[chat_id] = {
                 'active_download': None,
-                'queue': [],
+                'queue': {},
+                'url_index': {},
                 'last_user_message_id': None,
                 'selection_buttons_message_id': None
             }
             session = user_download_sessions[chat_id]
+            save_user_session(chat_id, session) # Fresh dict the scope never saw
 
-    session['last_user_message_id'] = last_user_message_id
+        session['last_user_message_id'] = last_user_message_id
 
-    # Regex to find all URLs in the message
-    urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', message_text)
-    
-    if not urls:
-        logger.info(f"[{chat_id}] Received message but no URL detected: {message_text}")
-        await update.message.reply_text("请发送有效的视频链接。")
-        return # No URLs found, do nothing
+        # Find all URLs in the message
+        urls = URL_RE.findall(message_text)
 
-    logger.info(f"[{chat_id}] Detected {len(urls)} URLs.")
+        if not urls:
+            logger.info("[%s] Received message but no URL detected: %s", chat_id, message_text)
+            await _tg(update.message.reply_text, "请发送有效的视频链接。")
+            return # No URLs found, do nothing
 
-    # Delete previous selection buttons message if it exists
-    if session['selection_buttons_message_id']:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=session['selection_buttons_message_id'])
-            session['selection_buttons_message_id'] = None
-        except Exception as e:
-            logger.warning(f"[{chat_id}] Failed to delete old selection buttons message (handle_video_link): {e}")
-
-    # Use a set to track URLs already in the queue or active to avoid true duplicates
-    existing_urls = set()
-    if session['active_download']:
-        existing_urls.add(session['active_download']['url'])
-    for item in session['queue']:
-        existing_urls.add(item['url'])
-
-    new_items_added_count = 0
-    new_urls_to_fetch_titles = []
-    new_items_added_indices = [] # To track where new items are added in session['queue']
-
-    for i, url in enumerate(urls):
-        if url not in existing_urls:
-            # Generate a unique ID for each new item
-            item = {'url': url, 'title': '[解析中]', 'status': 'pending', 'unique_id': str(uuid.uuid4())} 
-            session['queue'].append(item)
-            new_items_added_indices.append(len(session['queue']) - 1)
-            new_urls_to_fetch_titles.append(url)
-            existing_urls.add(url) # Add to set immediately to avoid duplicates within the same message
-            new_items_added_count += 1
-        # If the URL *is* existing, but its status is 'parse_failed' or 'failed_last_attempt',
-        # we can prompt the user that it's already there and they can re-parse/retry.
-        else:
-            found_item = None
-            if session['active_download'] and session['active_download']['url'] == url:
-                found_item = session['active_download']
+        logger.info("[%s] Detected %s URLs.", chat_id, len(urls))
+
+        # Delete previous selection buttons message if it exists
+        if session['selection_buttons_message_id']:
+            try:
+                await _tg(context.bot.delete_message, chat_id=chat_id, message_id=session['selection_buttons_message_id'])
+                session['selection_buttons_message_id'] = None
+            except Exception as e:
+                logger.warning("[%s] Failed to delete old selection buttons message (handle_video_link): %s", chat_id, e)
+
+        # url_index gives O(1) dedup against the queue; the active download may not
+        # be in the queue, so its url still needs an explicit check.
+        url_index = session.setdefault('url_index', {})
+        active_url = session['active_download']['url'] if session['active_download'] else None
+
+        new_items_added_count = 0
+        new_urls_to_fetch_titles = []
+        new_item_unique_ids = [] # To track the new items added to session['queue']
+
+        for i, url in enumerate(urls):
+            if url not in url_index and url != active_url:
+                # Generate a unique ID for each new item
+                item = {'url': url, 'title': '[解析中]', 'status': 'pending', 'unique_id': _uid()}
+                _queue_add(session, item) # Also indexes the url, deduping within this message
+                new_item_unique_ids.append(item['unique_id'])
+                new_urls_to_fetch_titles.append(url)
+                new_items_added_count += 1
+            # If the URL *is* existing, but its status is 'parse_failed' or 'failed_last_attempt',
+            # we can prompt the user that it's already there and they can re-parse/retry.
             else:
-                for q_item in session['queue']:
-                    if q_item['url'] == url:
-                        found_item = q_item
-                        break
-            
-            if found_item and found_item['status'] in ['parse_failed', 'failed_last_attempt']:
-                await update.message.reply_text(f"视频 `{found_item.get('title', '未知视频')}` (链接：{url}) 已在列表中，状态为 `{found_item['status']}`。您可以使用 `/list` 重新操作。")
-                logger.info(f"[{chat_id}] User sent an existing failed URL. Not adding as new item.")
+                if session['active_download'] and session['active_download']['url'] == url:
+                    found_item = session['active_download']
+                else:
+                    found_item = session['queue'].get(url_index.get(url))
 
 
-    save_user_session(chat_id, session) # Save session after adding items with placeholder titles
+                if found_item and found_item['status'] in ['parse_failed', 'failed_last_attempt']:
+                    await _tg(update.message.reply_text, f"视频 `{found_item.get('title', '未知视频')}` (链接：{url}) 已在列表中，状态为 `{found_item['status']}`。您可以使用 `/list` 重新操作。")
+                    logger.info("[%s] User sent an existing failed URL. Not adding as new item.", chat_id)
 
-    if new_items_added_count == 0 and len(session['queue']) > 0:
-        pass # Do nothing, messages already sent above if applicable
-    
-    # Fetch titles concurrently for newly added items
-    # fetched_results will be a list of (title, error_type) tuples
-    fetched_results = await asyncio.gather(*[get_video_title(url) for url in new_urls_to_fetch_titles])
-    for i, (title, error_type) in enumerate(fetched_results):
-        queue_idx = new_items_added_indices[i]
-        # Only update if the item still exists at that index and its URL matches (not removed by clear_all)
-        if queue_idx < len(session['queue']) and session['queue'][queue_idx]['url'] == new_urls_to_fetch_titles[i]:
-            session['queue'][queue_idx]['title'] = title
-            if error_type: # If error_type is not None, it means parsing failed or timed out
-                session['queue'][queue_idx]['status'] = 'parse_failed' # Mark as parse failed
-            # If parsing was successful (error_type is None), keep 'pending' status
-            
-    save_user_session(chat_id, session) # Save session after updating titles and statuses
+        if new_items_added_count == 0 and len(session['queue']) > 0:
+            pass # Do nothing, messages already sent above if applicable
 
-    logger.info(f"[{chat_id}] Added {new_items_added_count} items to queue.")
+        # Fetch titles concurrently for newly added items
+        # fetched_results will be a list of (title, error_type) tuples
+        fetched_results = await asyncio.gather(*[get_video_title(url) for url in new_urls_to_fetch_titles])
+        for i, (title, error_type) in enumerate(fetched_results):
+            queued_item = session['queue'].get(new_item_unique_ids[i])
+            # Only update if the item still exists in the queue (not removed by clear_all)
+            if queued_item and queued_item['url'] == new_urls_to_fetch_titles[i]:
+                queued_item['title'] = title
+                if error_type: # If error_type is not None, it means parsing failed or timed out
+                    queued_item['status'] = 'parse_failed' # Mark as parse failed
+                # If parsing was successful (error_type is None), keep 'pending' status
 
-    # Re-display the list after adding and potentially updating titles
-    await list_downloads(chat_id, context, update_obj=update) # Pass chat_id and original update object
+        logger.info("[%s] Added %s items to queue.", chat_id, new_items_added_count)
+
+        # Re-display the list after adding and potentially updating titles
+        await list_downloads(chat_id, context, update_obj=update) # Pass chat_id and original update object
 
 
 async def button_callback_handler(update: Update, context):
     """Handles inline keyboard button callbacks."""
     query = update.callback_query
-    await query.answer() # Always answer the callback query
+    # Ack the tap immediately instead of after session load and edits; the
+    # client stops its spinner without waiting on anything we do below.
+    _fire_and_forget(query.answer(), 'callback answer')
 
     chat_id = query.message.chat_id
     data = query.data
 
-    # Always reload session data from file to get the latest state
-    session = load_user_session(chat_id) 
-    if not session: # Session corrupted or not found, re-initialize
-        user_download_sessions[chat_id] = {
-            'active_download': None,
-            'queue': [],
-            'last_user_message_id': None,
-            'selection_buttons_message_id': None
-        }
-        session = user_download_sessions[chat_id]
-        await context.bot.send_message(chat_id=chat_id, text="会话信息已过期或不存在，已重置。请重新发送链接。")
-        save_user_session(chat_id, session)
-        await list_downloads(chat_id, context, update_obj=update) # Refresh list after reset
-        return
-    user_download_sessions[chat_id] = session # Update in-memory session
-
-    # --- Dummy Button (Number Button that does nothing) ---
-    if data.startswith('_no_op_dummy_') or data == '_no_op':
-        logger.info(f"[{chat_id}] Clicked on a dummy button: {data}")
-        return
-
-    # --- Start Download Button (triggered by numbered buttons in list for pending/failed_last_attempt) ---
-    # --- Reparse Item Button (triggered by numbered buttons for parse_failed items) ---
-    if data.startswith('start_download_') or data.startswith('reparse_item_'):
-        is_reparse_action = data.startswith('reparse_item_')
-        item_id_to_process = data.split('_')[2] if not is_reparse_action else data.split('_')[2]
+    # The in-memory session is authoritative (every save updates it first);
+    # disk is only consulted on a cache miss, e.g. after a restart. The scope
+    # serializes callbacks so rapid taps cannot interleave read-modify-write
+    # cycles, and persists all of this handler's mutations in one save on exit.
+    async with session_scope(chat_id) as session:
+        if not session: # Session corrupted or not found, re-initialize
+            user_download_sessions[chat_id] = {
+                'active_download': None,
+                'queue': {},
+                'url_index': {},
+                'last_user_message_id': None,
+                'selection_buttons_message_id': None
+            }
+            session = user_download_sessions[chat_id]
+            await _tg(context.bot.send_message, chat_id=chat_id, text="会话信息已过期或不存在，已重置。请重新发送链接。")
+            save_user_session(chat_id, session)
+            await list_downloads(chat_id, context, update_obj=update) # Refresh list after reset
+            return
 
-        if session['active_download']:
-            await query.edit_message_text(
-                text="当前已有下载任务正在进行，请等待或取消当前任务。",
-                reply_markup=None # Remove buttons from the selection message
-            )
+        # --- Dummy Button (Number Button that does nothing) ---
+        if data.startswith('_no_op_dummy_') or data == '_no_op':
+            logger.info("[%s] Clicked on a dummy button: %s", chat_id, data)
             return
 
-        try:
-            selected_item_from_queue = None
-            # Find the item by unique_id (safer than index)
-            for q_item in session['queue']:
-                if q_item.get('unique_id') == item_id_to_process:
-                    selected_item_from_queue = q_item
-                    break
-
-            if not selected_item_from_queue:
-                logger.warning(f"[{chat_id}] Item with ID {item_id_to_process} not found in queue. It might have already been processed or removed.")
-                await query.edit_message_text(text="无效的选择，视频可能已被移除或正在处理中。请使用 `/list` 查看最新状态。")
-                await list_downloads(chat_id, context, update_obj=update) # Refresh the list
-                return
+        # --- Start Download Button (triggered by numbered buttons in list for pending/failed_last_attempt) ---
+        # --- Reparse Item Button (triggered by numbered buttons for parse_failed items) ---
+        if data.startswith('start_download_') or data.startswith('reparse_item_'):
+            is_reparse_action = data.startswith('reparse_item_')
+            item_id_to_process = data.split('_')[2] if not is_reparse_action else data.split('_')[2]
 
-            # Check item status before processing for 'start_download'
-            if not is_reparse_action and selected_item_from_queue['status'] not in ['pending', 'failed_last_attempt']:
-                await query.edit_message_text(text=f"该项目 `{selected_item_from_queue.get('title', '未知视频')}` 状态为 `{selected_item_from_queue['status']}`，无法开始下载。", parse_mode='Markdown')
-                await list_downloads(chat_id, context, update_obj=update) # Refresh the list if status doesn't allow immediate download
-                return
-            
-            # Check item status before processing for 'reparse_item'
-            if is_reparse_action and selected_item_from_queue['status'] != 'parse_failed':
-                await query.edit_message_text(text=f"该项目 `{selected_item_from_queue.get('title', '未知视频')}` 状态为 `{selected_item_from_queue['status']}`，无需重新解析。", parse_mode='Markdown')
-                await list_downloads(chat_id, context, update_obj=update) # Refresh the list
+            if session['active_download']:
+                await _tg(query.edit_message_text,
+                    text="当前已有下载任务正在进行，请等待或取消当前任务。",
+                    reply_markup=None # Remove buttons from the selection message
+                )
                 return
 
-            # 1. Acknowledge button click on the original message and remove its buttons
-            await query.edit_message_text(
-                text=f"正在处理您的请求，请稍候...",
-                parse_mode='Markdown',
-                reply_markup=None # Remove selection buttons
-            )
-            
-            # 2. Send a NEW message to be used for ongoing progress updates
-            status_message = await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"开始{'重新解析' if is_reparse_action else '下载'}：**{selected_item_from_queue.get('title', '未知视频')}**...",
-                parse_mode='Markdown'
-            )
-            selected_item_from_queue['initial_message_id'] = status_message.message_id
+            try:
+                # Find the item by unique_id (safer than index)
+                selected_item_from_queue = session['queue'].get(item_id_to_process)
+
+                if not selected_item_from_queue:
+                    logger.warning("[%s] Item with ID %s not found in queue. It might have already been processed or removed.", chat_id, item_id_to_process)
+                    await _tg(query.edit_message_text, text="无效的选择，视频可能已被移除或正在处理中。请使用 `/list` 查看最新状态。")
+                    await list_downloads(chat_id, context, update_obj=update) # Refresh the list
+                    return
+
+                # Check item status before processing for 'start_download'
+                if not is_reparse_action and selected_item_from_queue['status'] not in ['pending', 'failed_last_attempt']:
+                    await _tg(query.edit_message_text, text=f"该项目 `{selected_item_from_queue.get('title', '未知视频')}` 状态为 `{selected_item_from_queue['status']}`，无法开始下载。", parse_mode='Markdown')
+                    await list_downloads(chat_id, context, update_obj=update) # Refresh the list if status doesn't allow immediate download
+                    return
             
-            # Set the item as active download in session
-            session['active_download'] = selected_item_from_queue
-            # Update status in queue
-            for q_item in session['queue']:
-                if q_item.get('unique_id') == item_id_to_process:
-                    q_item['status'] = 'downloading' if not is_reparse_action else 'pending' # 'pending' for re-parse to re-evaluate after title fetch
-                    q_item['initial_message_id'] = status_message.message_id # Ensure queue item also has this updated
-                    break
-
-            save_user_session(chat_id, session) # Save state before starting download
-
-            if is_reparse_action:
-                logger.info(f"[{chat_id}] User requested re-parse for item ID: {item_id_to_process}")
-                # Re-fetch title and then attempt download if parsing is successful
-                title, error_type = await get_video_title(selected_item_from_queue['url'])
-                selected_item_from_queue['title'] = title
-                if error_type: # Parsing failed
-                    selected_item_from_queue['status'] = 'parse_failed'
-                    save_user_session(chat_id, session) # Save the 'parse_failed' status
-                    await context.bot.edit_message_text( # Edit the NEW status message
-                        chat_id=chat_id,
-                        message_id=status_message.message_id,
-                        text=f"重新解析视频 **{selected_item_from_queue.get('title', '未知视频')}** 失败：`{error_type}`。\n请重试或检查链接。",
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                else: # Parsing succeeded, proceed to download logic
-                    selected_item_from_queue['status'] = 'pending' # Reset to pending for download check
+                # Check item status before processing for 'reparse_item'
+                if is_reparse_action and selected_item_from_queue['status'] != 'parse_failed':
+                    await _tg(query.edit_message_text, text=f"该项目 `{selected_item_from_queue.get('title', '未知视频')}` 状态为 `{selected_item_from_queue['status']}`，无需重新解析。", parse_mode='Markdown')
+                    await list_downloads(chat_id, context, update_obj=update) # Refresh the list
+                    return
+
+                # 1. Acknowledge button click on the original message and remove its buttons
+                await _tg(query.edit_message_text,
+                    text=f"正在处理您的请求，请稍候...",
+                    parse_mode='Markdown',
+                    reply_markup=None # Remove selection buttons
+                )
+
+                # 2. Send a NEW message to be used for ongoing progress updates
+                status_message = await _tg(context.bot.send_message,
+                    chat_id=chat_id,
+                    text=f"开始{'重新解析' if is_reparse_action else '下载'}：**{selected_item_from_queue.get('title', '未知视频')}**...",
+                    parse_mode='Markdown'
+                )
+                selected_item_from_queue['initial_message_id'] = status_message.message_id
+
+                # Set the item as active download in session. selected_item_from_queue is the
+                # queue entry itself, so updating it updates the queue in one go.
+                session['active_download'] = selected_item_from_queue
+                selected_item_from_queue['status'] = 'downloading' if not is_reparse_action else 'pending' # 'pending' for re-parse to re-evaluate after title fetch
+
+                if is_reparse_action:
+                    logger.info("[%s] User requested re-parse for item ID: %s", chat_id, item_id_to_process)
+                    # Re-fetch title and then attempt download if parsing is successful
+                    title, error_type = await get_video_title(selected_item_from_queue['url'])
+                    selected_item_from_queue['title'] = title
+                    if error_type: # Parsing failed
+                        selected_item_from_queue['status'] = 'parse_failed'
+                        await _tg(context.bot.edit_message_text,  # Edit the NEW status message
+                            chat_id=chat_id,
+                            message_id=status_message.message_id,
+                            text=f"重新解析视频 **{selected_item_from_queue.get('title', '未知视频')}** 失败：`{error_type}`。\n请重试或检查链接。",
+                            parse_mode='Markdown',
+                            reply_markup=None
+                        )
+                    else: # Parsing succeeded, proceed to download logic
+                        selected_item_from_queue['status'] = 'pending' # Reset to pending for download check
+                        selected_item_from_queue['format_string'] = 'best' # Start with best quality
+                        # session['active_download'] is already set above
+                        _enqueue_download(chat_id, session['active_download'], context) # Worker attempts the download
+                else: # It's a start_download_ click
+                    logger.info("[%s] User selected item %s (ID: %s) to start downloading.", chat_id, selected_item_from_queue.get('title'), item_id_to_process)
                     selected_item_from_queue['format_string'] = 'best' # Start with best quality
                     # session['active_download'] is already set above
-                    save_user_session(chat_id, session) # Save session after title update
-                    await download_and_send_video(chat_id, session['active_download'], context) # Attempt download
-            else: # It's a start_download_ click
-                logger.info(f"[{chat_id}] User selected item {selected_item_from_queue.get('title')} (ID: {item_id_to_process}) to start downloading.")
-                selected_item_from_queue['format_string'] = 'best' # Start with best quality
-                # session['active_download'] is already set above
-                save_user_session(chat_id, session) # Save session before download
-                await download_and_send_video(chat_id, session['active_download'], context)
-            
-            await list_downloads(chat_id, context, update_obj=update) # Always refresh list at the end
-            return
-        except Exception as e:
-            logger.error(f"[{chat_id}] Error in start_download/reparse logic for data: {data}, error: {e}", exc_info=True)
-            # If an error occurs, ensure the status message is updated and active_download is cleared
-            if session.get('active_download') and session['active_download'].get('unique_id') == item_id_to_process:
-                session['active_download']['status'] = 'failed_internal'
-                session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != item_id_to_process] # Remove from queue
-                session['active_download'] = None
-                save_user_session(chat_id, session)
-                try:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=status_message.message_id, # Use the new status message ID
-                        text=f"处理视频 **{selected_item_from_queue.get('title', '未知视频')}** 时发生错误：`{e}`。请稍后再试。",
-                        parse_mode='Markdown',
-                        reply_markup=None
-                    )
-                except Exception as edit_e:
-                    logger.error(f"[{chat_id}] Could not edit status message {status_message.message_id} after error: {edit_e}")
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"处理视频 **{selected_item_from_queue.get('title', '未知视频')}** 时发生错误：`{e}`。请稍后再试。",
-                        parse_mode='Markdown'
-                    )
-            else: # Fallback if active_download was already cleared
-                 await context.bot.send_message(chat_id=chat_id, text=f"处理请求时发生错误：`{e}`。请使用 `/list` 查看最新状态。")
-
-            await list_downloads(chat_id, context, update_obj=update) # Refresh the list
-            return
-            
-    # Add handler for `remove_item`
-    if data.startswith('remove_item_'):
-        try:
-            item_id_to_remove = data.split('_')[2]
-            original_queue_len = len(session['queue'])
+                    _enqueue_download(chat_id, session['active_download'], context)
             
-            # Remove from queue
-            session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != item_id_to_remove]
+                await list_downloads(chat_id, context, update_obj=update) # Always refresh list at the end
+                return
+            except Exception as e:
+                logger.error("[%s] Error in start_download/reparse logic for data: %s, error: %s", chat_id, data, e, exc_info=True)
+                # If an error occurs, ensure the status message is updated and active_download is cleared
+                if session.get('active_download') and session['active_download'].get('unique_id') == item_id_to_process:
+                    session['active_download']['status'] = 'failed_internal'
+                    _queue_pop(session, item_id_to_process) # Remove from queue
+                    session['active_download'] = None
+                    try:
+                        await _tg(context.bot.edit_message_text,
+                            chat_id=chat_id,
+                            message_id=status_message.message_id, # Use the new status message ID
+                            text=f"处理视频 **{selected_item_from_queue.get('title', '未知视频')}** 时发生错误：`{e}`。请稍后再试。",
+                            parse_mode='Markdown',
+                            reply_markup=None
+                        )
+                    except Exception as edit_e:
+                        logger.error("[%s] Could not edit status message %s after error: %s", chat_id, status_message.message_id, edit_e)
+                        await _tg(context.bot.send_message,
+                            chat_id=chat_id,
+                            text=f"处理视频 **{selected_item_from_queue.get('title', '未知视频')}** 时发生错误：`{e}`。请稍后再试。",
+                            parse_mode='Markdown'
+                        )
+                else: # Fallback if active_download was already cleared
+                     await _tg(context.bot.send_message, chat_id=chat_id, text=f"处理请求时发生错误：`{e}`。请使用 `/list` 查看最新状态。")
+
+                await list_downloads(chat_id, context, update_obj=update) # Refresh the list
+                return
             
-            # IMPORTANT: If the item to remove is currently in active_download, clear active_download.
-            if session.get('active_download') and session['active_download'].get('unique_id') == item_id_to_remove:
-                session['active_download'] = None
-                logger.info(f"[{chat_id}] Removed active_download item with ID: {item_id_to_remove}")
-
-            if len(session['queue']) < original_queue_len or (session.get('active_download') is None and original_queue_len == len(session['queue'])):
-                save_user_session(chat_id, session)
-                await query.edit_message_text(text="已从列表中移除。", reply_markup=None) # Remove buttons on the old message
-                logger.info(f"[{chat_id}] User removed item with ID: {item_id_to_remove}")
-            else:
-                await query.edit_message_text(text="该项目不存在或已被处理。请使用 `/list` 查看最新状态。")
+        # Add handler for `remove_item`
+        if data.startswith('remove_item_'):
+            try:
+                item_id_to_remove = data.split('_')[2]
 
-            await list_downloads(chat_id, context, update_obj=update) # Refresh the list after removal
-            return
-        except Exception as e:
-            logger.error(f"[{chat_id}] Error in remove_item logic: {data}, error: {e}", exc_info=True)
-            await context.bot.send_message(chat_id=chat_id, text="移除项目时发生错误。")
-            return
+                # Remove from queue
+                removed_item = _queue_pop(session, item_id_to_remove)
+
+                # IMPORTANT: If the item to remove is currently in active_download, clear active_download.
+                if session.get('active_download') and session['active_download'].get('unique_id') == item_id_to_remove:
+                    session['active_download'] = None
+                    removed_item = removed_item or True
+                    logger.info("[%s] Removed active_download item with ID: %s", chat_id, item_id_to_remove)
+
+                if removed_item or session.get('active_download') is None:
+                    await _tg(query.edit_message_text, text="已从列表中移除。", reply_markup=None) # Remove buttons on the old message
+                    logger.info("[%s] User removed item with ID: %s", chat_id, item_id_to_remove)
+                else:
+                    await _tg(query.edit_message_text, text="该项目不存在或已被处理。请使用 `/list` 查看最新状态。")
 
-    # --- Clear All Button ---
-    if data == 'clear_all':
-        # If there's an active download, it needs to be cancelled first (optional, but good practice)
-        if session['active_download']:
-            session['active_download']['status'] = 'cancelled' # Mark active as cancelled
-            logger.info(f"[{chat_id}] Clearing list: active download {session['active_download'].get('title')} marked as cancelled.")
+                await list_downloads(chat_id, context, update_obj=update) # Refresh the list after removal
+                return
+            except Exception as e:
+                logger.error("[%s] Error in remove_item logic: %s, error: %s", chat_id, data, e, exc_info=True)
+                await _tg(context.bot.send_message, chat_id=chat_id, text="移除项目时发生错误。")
+                return
+
+        # --- Clear All Button ---
+        if data == 'clear_all':
+            # If there's an active download, it needs to be cancelled first (optional, but good practice)
+            if session['active_download']:
+                session['active_download']['status'] = 'cancelled' # Mark active as cancelled
+                logger.info("[%s] Clearing list: active download %s marked as cancelled.", chat_id, session['active_download'].get('title'))
         
-        session['active_download'] = None
-        session['queue'] = []
-        save_user_session(chat_id, session)
-        # Delete the current message with buttons
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
-        except Exception as e:
-            logger.warning(f"[{chat_id}] Failed to delete message after clear_all: {e}")
+            session['active_download'] = None
+            session['queue'] = {}
+            session['url_index'] = {}
+            # Delete the current message with buttons
+            try:
+                await _tg(context.bot.delete_message, chat_id=chat_id, message_id=query.message.message_id)
+            except Exception as e:
+                logger.warning("[%s] Failed to delete message after clear_all: %s", chat_id, e)
         
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="列表已清空。"
-        )
-        logger.info(f"[{chat_id}] User cleared the list.")
-        return
+            await _tg(context.bot.send_message,
+                chat_id=chat_id,
+                text="列表已清空。"
+            )
+            logger.info("[%s] User cleared the list.", chat_id)
+            return
 
-    # --- Quality selection or Cancel/Save for Active Download ---
-    # This section is still relevant for a download that is *currently* active and awaiting user input
-    # (e.g., after initial size estimation)
-    active_dl = session.get('active_download')
-    if not active_dl or active_dl.get('initial_message_id') != query.message.message_id:
-        # This check ensures that the buttons are for the *current* active download message
-        # If not, it means the message is old or the active download has changed.
-        try: 
-            await query.edit_message_text(text="该操作已过期或不适用于当前任务。请使用 `/list` 查看最新状态。")
-        except Exception: 
-            await context.bot.send_message(chat_id=chat_id, text="该操作已过期或不适用于当前任务。请使用 `/list` 查看最新状态。")
-        await list_downloads(chat_id, context, update_obj=update)
-        return
+        # --- Quality selection or Cancel/Save for Active Download ---
+        # This section is still relevant for a download that is *currently* active and awaiting user input
+        # (e.g., after initial size estimation)
+        active_dl = session.get('active_download')
+        if not active_dl or active_dl.get('initial_message_id') != query.message.message_id:
+            # This check ensures that the buttons are for the *current* active download message
+            # If not, it means the message is old or the active download has changed.
+            try: 
+                await _tg(query.edit_message_text, text="该操作已过期或不适用于当前任务。请使用 `/list` 查看最新状态。")
+            except Exception: 
+                await _tg(context.bot.send_message, chat_id=chat_id, text="该操作已过期或不适用于当前任务。请使用 `/list` 查看最新状态。")
+            await list_downloads(chat_id, context, update_obj=update)
+            return
     
-    url = active_dl['url']
-    initial_message_id = active_dl['initial_message_id']
-    video_title = active_dl['title']
-
-    ack_message_text = ""
-    should_retry_download = False
-    format_to_try = None
-
-    if data == 'quality_medium':
-        ack_message_text = f"您选择了：中等质量。正在重新尝试下载视频 **{video_title}**..."
-        should_retry_download = True
-        format_to_try = 'bestvideo[height<=720]+bestaudio/best[height<=720]/bestvideo[height<=480]+bestaudio/best[height<=480]'
-        active_dl['status'] = 'downloading' # Reset status for retry
-    elif data == 'quality_lowest':
-        ack_message_text = f"您选择了：最低质量。正在重新尝试下载视频 **{video_title}**..."
-        should_retry_download = True
-        format_to_try = 'worst'
-        active_dl['status'] = 'downloading' # Reset status for retry
-    elif data == 'save_to_list': # New "Save to List" option
-        # Find the item in the queue by unique_id and update its status to pending
-        found_in_queue = False
-        for idx, q_item in enumerate(session['queue']):
-            if q_item.get('unique_id') == active_dl.get('unique_id'):
-                session['queue'][idx]['status'] = 'pending'
-                found_in_queue = True
-                break
+        url = active_dl['url']
+        initial_message_id = active_dl['initial_message_id']
+        video_title = active_dl['title']
+
+        ack_message_text = ""
+        should_retry_download = False
+        format_to_try = None
+
+        if data == 'quality_medium':
+            ack_message_text = f"您选择了：中等质量。正在重新尝试下载视频 **{video_title}**..."
+            should_retry_download = True
+            format_to_try = 'bestvideo[height<=720]+bestaudio/best[height<=720]/bestvideo[height<=480]+bestaudio/best[height<=480]'
+            active_dl['status'] = 'downloading' # Reset status for retry
+        elif data == 'quality_lowest':
+            ack_message_text = f"您选择了：最低质量。正在重新尝试下载视频 **{video_title}**..."
+            should_retry_download = True
+            format_to_try = 'worst'
+            active_dl['status'] = 'downloading' # Reset status for retry
+        elif data == 'save_to_list': # New "Save to List" option
+            # Find the item in the queue by unique_id and update its status to pending
+            active_uid = active_dl.get('unique_id')
+            if active_uid in session['queue']:
+                session['queue'][active_uid]['status'] = 'pending'
+            else: # This case should ideally not happen if active_dl was from a parsed URL
+                active_dl['status'] = 'pending'
+                # No need for a new id if it's already in active, it already has one.
+                _queue_add(session, active_dl.copy()) # Make a copy
         
-        if not found_in_queue: # This case should ideally not happen if active_dl was from a parsed URL
-            active_dl['status'] = 'pending'
-            item_to_save = active_dl.copy() # Make a copy
-            # No need for new uuid if it's already in active, it already has one.
-            session['queue'].append(item_to_save)
+            session['active_download'] = None # Clear active download
+            logger.info("[%s] User chose to save to list.", chat_id)
+            # Edit the refreshed list straight into the status message: one API
+            # call instead of an ack edit followed by a separate list send.
+            await list_downloads(chat_id, context, update_obj=update, edit_message_id=initial_message_id)
+            return # Important: exit after saving to list
+
+        elif data == 'cancel_download':
+            ack_message_text = f"已取消视频 **{video_title}** 的下载。"
+            should_retry_download = False # Explicitly do not retry
         
-        ack_message_text = f"视频 **{video_title}** 已保存回待处理列表。您可以使用 `/list` 查看。"
-        session['active_download'] = None # Clear active download
-        save_user_session(chat_id, session) # Save state
-        await context.bot.edit_message_text(
+            # If the item was originally from the queue, mark it as cancelled in the queue
+            # For simplicity, if cancelled, just remove it from queue.
+            # This prevents cancelled items from sticking around if they were from the queue.
+            _queue_pop(session, active_dl.get('unique_id'))
+            session['active_download'] = None # Clear active download
+
+        # Edit the initial message to show user's choice or cancel status, and remove buttons
+        await _tg(context.bot.edit_message_text,
             chat_id=chat_id,
             message_id=initial_message_id,
             text=ack_message_text,
             parse_mode='Markdown',
             reply_markup=None
         )
-        logger.info(f"[{chat_id}] User chose to save to list.")
-        # After saving to list, it's good to refresh the list view for the user
-        await list_downloads(chat_id, context, update_obj=update)
-        return # Important: exit after saving to list
-
-    elif data == 'cancel_download':
-        ack_message_text = f"已取消视频 **{video_title}** 的下载。"
-        should_retry_download = False # Explicitly do not retry
-        
-        # If the item was originally from the queue, mark it as cancelled in the queue
-        # For simplicity, if cancelled, just remove it from queue.
-        # This prevents cancelled items from sticking around if they were from the queue.
-        session['queue'] = [q_item for q_item in session['queue'] if q_item.get('unique_id') != active_dl.get('unique_id')]
-        session['active_download'] = None # Clear active download
-        save_user_session(chat_id, session) # Save state
-
-    # Edit the initial message to show user's choice or cancel status, and remove buttons
-    await context.bot.edit_message_text(
-        chat_id=chat_id,
-        message_id=initial_message_id,
-        text=ack_message_text,
-        parse_mode='Markdown',
-        reply_markup=None
-    )
-    logger.info(f"[{chat_id}] User choice: {data.replace('quality_', '')} quality.")
+        logger.info("[%s] User choice: %s quality.", chat_id, data.replace('quality_', ''))
 
-    if should_retry_download:
-        active_dl['format_string'] = format_to_try # Update format for retry
-        await download_and_send_video(chat_id, session['active_download'], context) # Pass active_download
-    
-    # Always refresh the list after a quality selection or cancellation
-    await list_downloads(chat_id, context, update_obj=update)
+        if should_retry_download:
+            active_dl['format_string'] = format_to_try # Update format for retry
+            _enqueue_download(chat_id, session['active_download'], context) # Worker refreshes the list when done
+        else:
+            # Refresh the list right away after a cancellation
+            await list_downloads(chat_id, context, update_obj=update)
+
+
+async def _post_init(application):
+    """Starts background tasks once the application's event loop is running."""
+    application.create_task(_session_flusher())
 
+async def _post_shutdown(application):
+    """Flushes any still-dirty sessions to disk before the process exits."""
+    flush_all_sessions()
+    if _sessions_db is not None:
+        _sessions_db.close()
 
 # --- Main function: Starts the bot ---
-def main():
-    """Starts the bot."""
-    logger.info("Checking and updating yt-dlp...")
+# Timestamp file recording the last successful yt-dlp self-update, so frequent
+# restarts (deploys, supervisor crash-loops) don't each pay the update RTT.
+YTDLP_UPDATE_STAMP_PATH = os.path.join(USER_DATA_DIR, ".yt_dlp_last_update")
+YTDLP_UPDATE_INTERVAL_SECONDS = 24 * 3600
+
+def _update_yt_dlp():
+    """Runs yt-dlp -U and stamps the check time (blocking; run off-thread)."""
     try:
         update_result = subprocess.run(['yt-dlp', '-U'], capture_output=True, text=True, check=True)
-        logger.info(f"yt-dlp update successful: {update_result.stdout}")
+        logger.info("yt-dlp update successful: %s", update_result.stdout)
         if update_result.stderr:
-            logger.warning(f"yt-dlp update warnings/errors: {update_result.stderr}")
+            logger.warning("yt-dlp update warnings/errors: %s", update_result.stderr)
+        with open(YTDLP_UPDATE_STAMP_PATH, 'w') as f:
+            f.write(str(int(time.time())))
     except subprocess.CalledProcessError as e:
-        logger.error(f"yt-dlp update failed (command returned non-zero exit code): {e.stderr}")
-    except FileNotFoundError:
-        logger.error("yt-dlp command not found. Please ensure yt-dlp is installed and configured in your system's PATH.")
-        exit(1)
+        logger.error("yt-dlp update failed (command returned non-zero exit code): %s", e.stderr)
     except Exception as e:
-        logger.error(f"Unknown error during yt-dlp update: {e}")
+        logger.error("Unknown error during yt-dlp update: %s", e)
 
-    # Load all existing user sessions at startup
-    for filename in os.listdir(USER_DATA_DIR):
-        if filename.endswith(".json"):
-            try:
-                chat_id = int(filename.split('.')[0])
-                session_data = load_user_session(chat_id)
-                if session_data:
-                    # For existing items loaded from file, ensure they have a unique_id
-                    # This handles sessions saved before unique_id was introduced
-                    for item in session_data['queue']:
-                        if 'unique_id' not in item:
-                            item['unique_id'] = str(uuid.uuid4())
-                    if session_data['active_download'] and 'unique_id' not in session_data['active_download']:
-                        session_data['active_download']['unique_id'] = str(uuid.uuid4())
-                    user_download_sessions[chat_id] = session_data
-                    save_user_session(chat_id, session_data) # Save to update with unique_ids
-                    logger.info(f"Loaded and updated session data for user {chat_id}.")
-                else:
-                    logger.warning(f"Could not load session data for user {chat_id}, file might be corrupted.")
-            except (ValueError, IndexError):
-                logger.warning(f"Skipping non-standard user data file: {filename}")
-
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).read_timeout(300).write_timeout(300).connect_timeout(300).build()
+def main():
+    """Starts the bot."""
+    if shutil.which('yt-dlp') is None:
+        logger.error("yt-dlp command not found. Please ensure yt-dlp is installed and configured in your system's PATH.")
+        exit(1)
+    try:
+        last_update_check = os.path.getmtime(YTDLP_UPDATE_STAMP_PATH)
+    except OSError:
+        last_update_check = 0.0
+    if time.time() - last_update_check < YTDLP_UPDATE_INTERVAL_SECONDS:
+        logger.info("yt-dlp was checked for updates recently, skipping.")
+    else:
+        # Run the update off the main thread so the bot starts serving
+        # immediately; a download racing the swap just uses the old binary.
+        logger.info("Checking and updating yt-dlp in the background...")
+        threading.Thread(target=_update_yt_dlp, daemon=True).start()
+
+    # Load all existing user sessions at startup: every row in the store, plus
+    # any legacy per-chat JSON files not yet migrated into it.
+    store_chat_ids = {row[0] for row in _get_sessions_db().execute("SELECT chat_id FROM sessions")}
+    known_chat_ids = set(store_chat_ids)
+    # scandir streams DirEntry objects with cached file types, avoiding the
+    # extra stat per name that listdir-plus-checks would cost on big dirs.
+    with os.scandir(USER_DATA_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                try:
+                    known_chat_ids.add(int(entry.name.split('.')[0]))
+                except ValueError:
+                    logger.warning("Skipping non-standard user data file: %s", entry.name)
+    # Session reads are I/O-bound (store page reads plus any legacy JSON
+    # files), so load them in parallel instead of paying one disk stall per
+    # chat before the bot starts accepting updates.
+    chat_ids = list(known_chat_ids)
+    loaded_sessions = []
+    if chat_ids:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(chat_ids))) as executor:
+            loaded_sessions = list(executor.map(_read_session_file, chat_ids))
+    for chat_id, session_data in zip(chat_ids, loaded_sessions):
+        if session_data:
+            # Only re-save sessions the load actually changed: legacy JSON
+            # files that must migrate into the store, and pre-unique_id
+            # sessions getting their backfill (queue items get theirs during
+            # the list-to-dict migration on load, also legacy-only).
+            mutated = chat_id not in store_chat_ids
+            if session_data['active_download'] and 'unique_id' not in session_data['active_download']:
+                session_data['active_download']['unique_id'] = _uid()
+                mutated = True
+            user_download_sessions[chat_id] = session_data
+            if mutated:
+                save_user_session(chat_id, session_data) # Save to migrate into the store
+            logger.info("Loaded session data for user %s.", chat_id)
+        else:
+            logger.warning("Could not load session data for user %s, data might be corrupted.", chat_id)
+
+    # write_timeout covers streaming multi-GB upload bodies, so it gets more
+    # headroom than the read/connect timeouts. The connection pool is sized
+    # well above the default 1 so concurrent chats reuse warm connections
+    # instead of queueing on the pool or paying fresh TLS handshakes; uploads
+    # can hold a connection for minutes, hence the generous pool_timeout.
+    # concurrent_updates lets independent chats be dispatched in parallel;
+    # per-chat ordering is preserved by the session locks and worker queues.
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).connection_pool_size(64).read_timeout(300).write_timeout(600).connect_timeout(300).pool_timeout(60).get_updates_pool_timeout(60).post_init(_post_init).post_shutdown(_post_shutdown)
+    if TELEGRAM_BOT_API_BASE_URL:
+        logger.info("Using local Bot API server at %s (local mode).", TELEGRAM_BOT_API_BASE_URL)
+        builder = builder.base_url(f"{TELEGRAM_BOT_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BOT_API_BASE_URL}/file/bot").local_mode(True)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("list", lambda update, context: list_downloads(update.effective_chat.id, context, update_obj=update))) # Pass update object
-    # Use a more general regex that captures URLs and passes them to handle_video_link
+    application.add_handler(CommandHandler("list", list_command))
+    # Gate messages on the same precompiled pattern handle_video_link extracts
+    # URLs with, so the filter and the handler can never disagree.
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.Regex(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+') & ~filters.COMMAND,
+        filters.TEXT & filters.Regex(URL_RE) & ~filters.COMMAND,
         handle_video_link
     ))
     application.add_handler(CallbackQueryHandler(button_callback_handler))